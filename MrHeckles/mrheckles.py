@@ -1,108 +1,676 @@
 # This is a skeleton for Err plugins, use this to get started quickly.
 
 from errbot import BotPlugin, botcmd
+from errbot.utils import ValidationException
 #from errbot.builtins.webserver import webhook
 
-import socket, re, unidecode, sys
+import socket, re, unidecode, sys, threading, time, collections, struct, json, os, unicodedata, logging
 
-hecklechat = 'heckleproxy'
+try:
+    from functools import lru_cache
+except ImportError:
+    try:
+        from backports.functools_lru_cache import lru_cache
+    except ImportError:
+        lru_cache = None  # names are just normalized every time
+try:
+    from time import monotonic
+except ImportError:
+    from monotonic import monotonic
+
+# The relay's threads log here, as the plugin's own self.log does
+log = logging.getLogger('errbot.plugins.MrHeckles')
+
+hecklechat = 'heckleproxy'   # channel relayed when none are configured
 host = 'localhost'
 port = 8000
-size = 1024
-hecklesocket = None
+style = u'<{name}> {text}'   # how a heckle is shown; {name} and {text}
+size = 65536
+connect_timeout = 2.0
+reconnect_min = 0.5   # seconds, doubled after every failed attempt...
+reconnect_max = 30.0  # ...up to this
+queue_size = 1000     # messages waiting to be sent; the oldest go first
+latency_samples = 1000  # recent enqueue-to-ack times kept for !heckles stats
+recordfile = 'heckles.jsonl'  # append-only log of the session
+channel_recordfile = '{channel}.jsonl'  # ...of a channel configured without one
+exportfile = 'heckles.json'   # default for !heckles export...
+exportdir = 'exports'         # ...which only ever writes in here
+sync_interval = 5.0           # seconds between fsyncs of the log
+annotation_duration = 10.0    # seconds, how long the player shows a heckle
+flush_interval = 0.25         # seconds between releases of held heckles
+name_cache_size = 1024        # display names kept normalized
 
-def socket_reconnect(fromname, msgbody):
-    global hecklesocket
-    try:
-        hecklesocket.close()
-    except:
-        pass
-    hecklesocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+# Channels to relay, by name, each to its own player, plus rate limits in
+# heckles per second with bursts of up to so many at once.  Overridden with
+# !plugin config "Mr. Heckles" {...}; channels may leave out any of host,
+# port, style and record (see player_logs).
+default_config = {
+    'CHANNELS': {
+        hecklechat: {'host': host, 'port': port, 'style': style, 'record': recordfile},
+    },
+    'USER_RATE': 0.5,      # each person
+    'USER_BURST': 3,
+    'CHANNEL_RATE': 2.0,   # the room as a whole
+    'CHANNEL_BURST': 6,
+    'GLOBAL_RATE': 3.0,    # everything shown on the overlay
+    'GLOBAL_BURST': 8,
+    'MERGE_MAX': 300,      # characters in a line merged from held heckles
+    'TRANSLITERATE': True, # down to ASCII; turn off if the player's font has the glyphs
+}
+
+# Slack escapes < and >, so a relayed "<name> text" arrives as this
+fakename_pattern = re.compile(r'&lt;(.*)&gt;(.*)')
+
+def is_ascii(text):
     try:
-        hecklesocket.connect((host,port))
-    except:
-        pass
-    else:
+        text.encode('ascii')
+    except (UnicodeEncodeError, UnicodeDecodeError):
+        return False
+    return True
+
+def transliterate(text):
+    """Approximate text in ASCII, for fonts without accents or emoji"""
+    if is_ascii(text):
+        return text
+    return unidecode.unidecode(text)
+
+def keep_unicode(text):
+    """Compose accents, so fonts that have them needn't combine marks"""
+    if is_ascii(text):
+        return text
+    return unicodedata.normalize('NFC', text)
+
+def normalizers(transliterating):
+    """Return the (text, name) normalizers, the second cached"""
+    normalize = transliterate if transliterating else keep_unicode
+    if lru_cache is None:
+        return normalize, normalize
+    return normalize, lru_cache(maxsize=name_cache_size)(normalize)
+
+def player_logs(channels):
+    """Map each player's (host, port) to the log its channels share: the
+    record of the first of them by name, or channel_recordfile named after
+    that channel"""
+    logs = {}
+    for name in sorted(channels):
+        channel = channels[name]
+        target = (channel.get('host', host), int(channel.get('port', port)))
+        if target not in logs:
+            logs[target] = channel.get('record', channel_recordfile.format(channel=name))
+    return logs
+
+class SessionRecorder(object):
+    """Append-only log of every relayed heckle and the video position it
+    was shown at, one JSON object per line.
+
+    Every line is flushed to the OS as it is recorded, so it survives the
+    bot crashing, and the plugin's poller calls sync() every sync_interval
+    seconds, so a power cut or OS crash loses at most that much.  export()
+    turns the log into the JSON array of VideoPlayerAnnotation-style
+    objects that snarkyscreenshots.py reads."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.fd = open(path, 'a')
+        self.dirty = False
+
+    def record(self, text, position):
         try:
-            hecklesocket.send('{}{}'.format(fromname, msgbody))
-        except:
-            pass
-        else:
+            start = float(position)
+        except ValueError:
+            return
+        line = json.dumps({'start': start, 'text': text}) + '\n'
+        with self.lock:
+            self.fd.write(line)
+            self.fd.flush()
+            self.dirty = True
+
+    def sync(self):
+        """fsync whatever was recorded since the last sync"""
+        with self.lock:
+            self._sync()
+
+    def _sync(self):
+        # Called with self.lock held
+        if self.dirty and not self.fd.closed:
+            os.fsync(self.fd.fileno())
+            self.dirty = False
+
+    def close(self):
+        with self.lock:
+            self._sync()
+            self.fd.close()
+
+    def export(self, path):
+        """Write the session so far to path, returning the number of heckles"""
+        with self.lock:
+            self.fd.flush()
+        count = 0
+        tmppath = path + '.tmp'
+        with open(self.path, 'r') as log, open(tmppath, 'w') as out:
+            out.write('[\n')
+            for line in log:
+                try:
+                    quote = json.loads(line)
+                except ValueError:
+                    continue  # torn final line after a crash
+                quote['duration'] = annotation_duration
+                out.write('{}{}'.format(',\n' if count else '', json.dumps(quote)))
+                count += 1
+            out.write('\n]\n')
+        os.rename(tmppath, path)
+        return count
+
+class TokenBucket(object):
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.stamp = time.time()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        return self.tokens >= 1
+
+    @property
+    def full(self):
+        return self.tokens >= self.burst
+
+class HeckleLimiter(object):
+    """Token buckets for every person, every room and the overlay as a
+    whole.  A heckle is let through only when all three have a token to
+    spare; otherwise it is held, and anything else the same person says in
+    the meantime is merged into the same line, which goes out when the
+    buckets allow.  Busy rooms therefore show fewer, longer lines, and the
+    player never has to lay out more than GLOBAL_RATE a second."""
+
+    def __init__(self, config):
+        self.config = config
+        self.lock = threading.Lock()
+        self.users = {}
+        self.channels = {}
+        self.overall = TokenBucket(config['GLOBAL_RATE'], config['GLOBAL_BURST'])
+        self.held = collections.OrderedDict()
+        self.passed = 0
+        self.merged = 0
+
+    def buckets(self, channel, name, now):
+        user = self.users.get((channel, name))
+        if user is None:
+            user = self.users[(channel, name)] = TokenBucket(self.config['USER_RATE'], self.config['USER_BURST'])
+        room = self.channels.get(channel)
+        if room is None:
+            room = self.channels[channel] = TokenBucket(self.config['CHANNEL_RATE'], self.config['CHANNEL_BURST'])
+        buckets = (user, room, self.overall)
+        ready = all([bucket.refill(now) for bucket in buckets])
+        return buckets, ready
+
+    def admit(self, channel, name, text, timing=None):
+        """Return the (name, text, timing) to send now, or None if it was
+        held"""
+        with self.lock:
+            key = (channel, name)
+            if key in self.held:
+                self.held[key][1].append(text)
+                self.merged += 1
+                return None
+            buckets, ready = self.buckets(channel, name, time.time())
+            if not ready:
+                # A merged line is timed from its first heckle
+                self.held[key] = (timing, [text])
+                return None
+            for bucket in buckets:
+                bucket.tokens -= 1
+            self.passed += 1
+            return name, text, timing
+
+    def release(self):
+        """Return a (channel, name, text, timing) for every held line the
+        buckets now allow, in the order they were first held"""
+        released = []
+        now = time.time()
+        with self.lock:
+            for key, (timing, texts) in list(self.held.items()):
+                buckets, ready = self.buckets(key[0], key[1], now)
+                if not ready:
+                    continue
+                for bucket in buckets:
+                    bucket.tokens -= 1
+                del self.held[key]
+                self.passed += 1
+                text = u' / '.join(texts)
+                if len(text) > self.config['MERGE_MAX']:
+                    text = text[:self.config['MERGE_MAX'] - 1].rstrip() + u'\u2026'
+                released.append((key[0], key[1], text, timing))
+            # Forget people who have gone quiet; a new bucket starts full
+            for key, bucket in list(self.users.items()):
+                if key not in self.held and bucket.full:
+                    del self.users[key]
+        return released
+
+# Where a channel's heckles go: the channel's name, the relay and recorder
+# of its player, and the style format string.
+Route = collections.namedtuple('Route', 'name relay recorder style')
+
+# What the relay queues: the style to show it in, who said it and what, and
+# the timestamps it has picked up so far (see HeckleRelay.write)
+Heckle = collections.namedtuple('Heckle', 'style name text timing')
+
+# Wire protocol shared with main.py: every message in either direction is a
+# frame of a 4-byte big-endian length followed by that many bytes, matching
+# Twisted's Int32StringReceiver.  Heckles are sent as a JSON object with a
+# "text" key, optionally with a "timing" object of monotonic timestamps for
+# latency tracing, and the player answers each one, in order, with its
+# video position as an ASCII number.
+frame_header = struct.Struct('!I')
+
+def encode_frame(payload):
+    return frame_header.pack(len(payload)) + payload
+
+def encode_message(text, timing=None):
+    message = {'text': text}
+    if timing:
+        message['timing'] = timing
+    return encode_frame(json.dumps(message))
+
+def decode_frames(buf):
+    """Split complete frames off the front of buf; returns (frames, rest)"""
+    frames = []
+    offset = 0
+    while len(buf) - offset >= frame_header.size:
+        (length,) = frame_header.unpack_from(buf, offset)
+        end = offset + frame_header.size + length
+        if len(buf) < end:
+            break
+        frames.append(buf[offset + frame_header.size:end])
+        offset = end
+    return frames, buf[offset:]
+
+class HeckleRelay(object):
+    """Persistent connection to the snarky-screening player.
+
+    send() only puts messages on a bounded queue, so it never blocks the
+    caller; when the queue is full the oldest message is dropped.  Two
+    background threads own the connection: one (re)connects with
+    exponential backoff and reads the video positions the player sends
+    back, matching them to messages in the order they were written, and the
+    other drains the queue, passing each item through format() and writing
+    everything waiting in a single framed write."""
+
+    def __init__(self, host, port, on_ack=None, format=None):
+        self.host = host
+        self.port = port
+        self.on_ack = on_ack
+        self.format = format or (lambda item: item)
+        self.sock = None
+        self.lock = threading.Condition()
+        self.queue = collections.deque(maxlen=queue_size)
+        self.inflight = collections.deque()
+        self.latencies = collections.deque(maxlen=latency_samples)
+        self.queued = 0
+        self.dropped = 0
+        self.acked = 0
+        self.running = False
+        self.threads = []
+
+    def start(self):
+        self.running = True
+        self.threads = [threading.Thread(target=self.run, name='HeckleRelay'),
+                        threading.Thread(target=self.write, name='HeckleRelayWriter')]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        with self.lock:
+            self.running = False
+            self.disconnect()
+            self.lock.notify_all()
+        for thread in self.threads:
+            if thread is not threading.current_thread():
+                thread.join(connect_timeout)
+
+    def send(self, *items):
+        now = monotonic()
+        with self.lock:
+            for item in items:
+                if len(self.queue) == self.queue.maxlen:
+                    self.dropped += 1  # the deque drops the oldest to make room
+                self.queue.append((item, now))
+            self.queued += len(items)
+            self.lock.notify_all()
+
+    def stats(self):
+        """Queue depth, drop and ack counts, and enqueue-to-ack latencies"""
+        with self.lock:
+            return {
+                'connected': self.sock is not None,
+                'queued': self.queued,
+                'depth': len(self.queue),
+                'inflight': len(self.inflight),
+                'dropped': self.dropped,
+                'acked': self.acked,
+                'latencies': sorted(self.latencies),
+            }
+
+    def disconnect(self):
+        # Called with self.lock held.  Anything still waiting for a position
+        # may or may not have been shown, so it is dropped rather than resent.
+        if self.sock is not None:
             try:
-                data = hecklesocket.recv(size)
-            except:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
                 pass
-            else:
-                print '{{"start": {}, "text": "{}{}"}}'.format(data, fromname, msgbody)
+            self.sock.close()
+            self.sock = None
+        self.inflight.clear()
+
+    def requeue(self, batch):
+        # Called with self.lock held.  Put back a batch that wasn't written,
+        # ahead of anything queued since; if it no longer all fits, its
+        # oldest messages are the ones dropped.
+        overflow = len(batch) - (self.queue.maxlen - len(self.queue))
+        if overflow > 0:
+            self.dropped += overflow
+            batch = batch[overflow:]
+        self.queue.extendleft(reversed(batch))
+
+    def format_batch(self, batch):
+        """[(text, item, since)] for a batch; anything format() chokes on is
+        logged and dropped, rather than taking the writer thread with it"""
+        texts = []
+        for item, since in batch:
+            try:
+                texts.append((self.format(item), item, since))
+            except Exception:
+                log.exception('Cannot format %r for the player, dropping it', item)
+                with self.lock:
+                    self.dropped += 1
+        return texts
+
+    def write(self):
+        while True:
+            with self.lock:
+                while self.running and not (self.queue and self.sock is not None):
+                    # A timeout keeps the wait interruptible on Python 2
+                    self.lock.wait(1.0)
+                if not self.running:
+                    return
+                batch = list(self.queue)
+                self.queue.clear()
+                sock = self.sock
+            texts = self.format_batch(batch)
+            now = monotonic()
+            frames = ''.join(
+                encode_message(text, dict(getattr(item, 'timing', None) or {}, queued=since, sent=now))
+                for text, item, since in texts if text)
+            texts = [(text, since) for text, item, since in texts if text]
+            with self.lock:
+                if self.sock is not sock:
+                    self.requeue(batch)
+                    continue
+                # Only this thread writes, so the player's answers come back
+                # in the order the messages are registered here
+                self.inflight.extend(texts)
+            try:
+                sock.sendall(frames)
+            except socket.error:
+                with self.lock:
+                    if self.sock is sock:
+                        self.requeue(batch)
+                        self.disconnect()
 
-socket_reconnect('<Mr. Heckles> ', 'Ready!')
+    def run(self):
+        delay = reconnect_min
+        while self.running:
+            try:
+                sock = socket.create_connection((self.host, self.port), connect_timeout)
+            except socket.error:
+                time.sleep(delay)
+                delay = min(delay * 2, reconnect_max)
+                continue
+            delay = reconnect_min
+            sock.settimeout(None)
+            with self.lock:
+                self.sock = sock
+                self.lock.notify_all()
+            self.read(sock)
+            with self.lock:
+                if self.sock is sock:
+                    self.disconnect()
+
+    def read(self, sock):
+        buf = ''
+        while self.running:
+            try:
+                data = sock.recv(size)
+            except socket.error:
+                return
+            if not data:
+                return
+            positions, buf = decode_frames(buf + data)
+            acked = []
+            now = monotonic()
+            with self.lock:
+                for position in positions:
+                    if not self.inflight:
+                        break
+                    text, since = self.inflight.popleft()
+                    self.latencies.append(now - since)
+                    acked.append((text, position))
+                self.acked += len(acked)
+            if self.on_ack is not None:
+                for text, position in acked:
+                    self.on_ack(text, position)
 
 class MrHeckles(BotPlugin):
     """An Err plugin skeleton"""
     min_err_version = '1.6.0' # Optional, but recommended
     max_err_version = '3.2.2' # Optional, but recommended
 
-#   def activate(self):
-#       """Triggers on plugin activation
-#
-#       You should delete it if you're not using it to override any default behaviour"""
-#       super(Skeleton, self).activate()
+    def activate(self):
+        """Triggers on plugin activation"""
+        super(MrHeckles, self).activate()
+        self.start_relays(self.config or default_config)
+        self.resolve_channels()
+        self.start_poller(flush_interval, self.release_held)
+        self.start_poller(sync_interval, self.sync_logs)
 
-#   def deactivate(self):
-#       """Triggers on plugin deactivation
-#
-#       You should delete it if you're not using it to override any default behaviour"""
-#       super(Skeleton, self).deactivate()
+    def deactivate(self):
+        """Triggers on plugin deactivation"""
+        self.stop_poller(self.release_held)
+        self.stop_poller(self.sync_logs)
+        self.stop_relays()
+        super(MrHeckles, self).deactivate()
 
-#   def get_configuration_template(self):
-#       """Defines the configuration structure this plugin supports
-#
-#       You should delete it if your plugin doesn't use any configuration like this"""
-#       return {'EXAMPLE_KEY_1': "Example value",
-#               'EXAMPLE_KEY_2': ["Example", "Value"]
-#              }
+    def start_relays(self, config):
+        """Set up everything that doesn't need the bot, so snarkyreplay.py
+        can drive the plugin without one"""
+        self.limiter = HeckleLimiter(config)
+        self.normalize, self.normalize_name = normalizers(config.get('TRANSLITERATE', True))
+        # One relay and log per player, however many channels share it.
+        # check_configuration stops two players sharing a log, but never
+        # open one file twice, as the recorders' writes would interleave.
+        self.players = {}
+        self.channels = {}
+        self.recorders = {}
+        logs = player_logs(config['CHANNELS'])
+        for name, channel in config['CHANNELS'].items():
+            target = (channel.get('host', host), int(channel.get('port', port)))
+            if target not in self.players:
+                path = os.path.abspath(logs[target])
+                recorder = self.recorders.get(path)
+                if recorder is None:
+                    recorder = self.recorders[path] = SessionRecorder(path)
+                relay = HeckleRelay(target[0], target[1], on_ack=recorder.record, format=self.format_heckle)
+                relay.start()
+                relay.send(Heckle(style, u'Mr. Heckles', u'Ready!', None))
+                self.players[target] = (relay, recorder)
+            relay, recorder = self.players[target]
+            self.channels[name] = Route(name, relay, recorder, channel.get('style', style))
+        self.routes = {}
 
-#   def check_configuration(self, configuration):
-#       """Triggers when the configuration is checked, shortly before activation
-#
-#       You should delete it if you're not using it to override any default behaviour"""
-#       super(Skeleton, self).check_configuration()
+    def stop_relays(self):
+        for relay, recorder in self.players.values():
+            relay.stop()
+        for recorder in self.recorders.values():
+            recorder.close()
+
+    def sync_logs(self):
+        """Poller: fsync the session logs"""
+        for recorder in self.recorders.values():
+            recorder.sync()
+
+    def resolve_channels(self):
+        """Look up the ID of every configured channel, once, so messages
+        can be matched without a name lookup each"""
+        for name, route in self.channels.items():
+            if route in self.routes.values():
+                continue
+            try:
+                self.routes[self.query_room(name).id] = route
+            except Exception as e:
+                self.log.warning('Cannot find heckle channel %s yet: %s', name, e)
+
+    def get_configuration_template(self):
+        """Channels and rate limits; see default_config"""
+        return default_config
+
+    def configure(self, configuration):
+        """Fill in any limits the configuration leaves out"""
+        config = dict(default_config)
+        if configuration:
+            config.update(configuration)
+        super(MrHeckles, self).configure(config)
+
+    def check_configuration(self, configuration):
+        """Like the default check, except that CHANNELS can name any
+        channels, each with any of the keys in default_config's"""
+        configuration = dict(configuration)
+        channels = configuration.pop('CHANNELS', {})
+        if not isinstance(channels, dict) or not all(
+                isinstance(channel, dict) and set(channel) <= set(default_config['CHANNELS'][hecklechat])
+                for channel in channels.values()):
+            raise ValidationException('CHANNELS should map channel names to dicts with any of host, port, style and record')
+        for name, channel in channels.items():
+            try:
+                channel.get('style', style).format(name=u'x', text=u'y')
+            except (AttributeError, KeyError, IndexError, ValueError) as e:
+                raise ValidationException('The style of {} should only use {{name}} and {{text}}: {!r}'.format(name, e))
+        players = {}
+        for target, path in player_logs(channels).items():
+            other = players.setdefault(os.path.abspath(path), target)
+            if other != target:
+                raise ValidationException('The players at {}:{} and {}:{} would both log to {}'.format(
+                    other[0], other[1], target[0], target[1], path))
+        for key, value in configuration.items():
+            if key not in default_config:
+                raise ValidationException('Unknown setting {}'.format(key))
+            if not isinstance(value, (int, float)):
+                raise ValidationException('{} should be a number'.format(key))
+            # A bucket that can't hold a whole token holds every heckle forever
+            if key.endswith('_RATE') and value <= 0:
+                raise ValidationException('{} should be more than 0'.format(key))
+            if key.endswith('_BURST') and value < 1:
+                raise ValidationException('{} should be at least 1'.format(key))
+            if key == 'MERGE_MAX' and value < 2:
+                raise ValidationException('{} should be at least 2'.format(key))
+
+    def callback_connect(self):
+        """Triggers when bot is connected"""
+        self.resolve_channels()
 
-#   def callback_connect(self):
-#       """Triggers when bot is connected
-#
-#       You should delete it if you're not using it to override any default behaviour"""
-#       pass
-    
     def callback_message(self, message):
-        """Triggered for every received message that isn't coming from the bot itself
-        
-        You should delete it if you're not using it to override any default behaviour"""
-        
+        """Triggered for every received message that isn't coming from the bot itself"""
         if message.type == 'groupchat':
-            if message.frm.channelname == hecklechat:
-                fromname = ''
-                msgbody = unidecode.unidecode(message.body)
-                fakename = re.split(r'^&lt;(.*)&gt;(.*)', msgbody)
-                if len(fakename) == 4:
-                    fromname = '<{}> '.format(fakename[1])
-                    msgbody = fakename[2].strip()
+            route = self.routes.get(message.frm.channelid)
+            if route is not None:
+                # This runs on Errbot's dispatch thread, so only work out
+                # who said what; the relay's writer thread formats it.
+                name = None
+                msgbody = message.body
+                fakename = fakename_pattern.match(msgbody)
+                if fakename:
+                    name = fakename.group(1)
+                    msgbody = fakename.group(2).strip()
                 elif message.frm.fullname != '<None>':
-                    fromname = '<{}> '.format(message.frm.fullname)
+                    name = message.frm.fullname
                 elif 'sameroom_bot' in message.extras:
-                    fromname = '<{}> '.format(message.extras['sameroom_username'])
-                
-                try:
-                    hecklesocket.send('{}{}'.format(fromname, msgbody))
-                except:
-                    socket_reconnect(fromname, msgbody)
-                else:
-                    try:
-                        data = hecklesocket.recv(size)
-                    except:
-                        pass
-                    else:
-                        print '{{"start": {}, "text": "{}{}"}}'.format(data, fromname, msgbody)
+                    name = message.extras['sameroom_username']
+
+                timing = {}
+                if 'received_at' in message.extras:
+                    timing['received'] = message.extras['received_at']
+                if 'slack_lag' in message.extras:
+                    timing['slack_lag'] = message.extras['slack_lag']
+                heckle = self.limiter.admit(route.name, name, msgbody, timing)
+                if heckle is not None:
+                    route.relay.send(Heckle(route.style, *heckle))
+
+    def release_held(self):
+        """Poller: send the held heckles the rate limits now allow"""
+        for channel, name, text, timing in self.limiter.release():
+            route = self.channels[channel]
+            route.relay.send(Heckle(route.style, name, text, timing))
+
+    def format_heckle(self, item):
+        """Turn a Heckle into the line the player shows"""
+        style, name, text, timing = item
+        msgbody = self.normalize(text)
+        if name is None:
+            return msgbody
+        return style.format(name=self.normalize_name(name), text=msgbody)
+
+    def route_for(self, message):
+        """The route of the channel message was said in, or the only one"""
+        if message.type == 'groupchat' and message.frm.channelid in self.routes:
+            return self.routes[message.frm.channelid]
+        if len(self.players) == 1:
+            return list(self.channels.values())[0]
+        return None
+
+    @botcmd(admin_only=True)
+    def heckles_export(self, message, args):
+        """Export the session so far as annotations for snarkyscreenshots.py"""
+        route = self.route_for(message)
+        if route is None:
+            return 'Say this in the channel whose screening you want to export'
+        # Only a file name, always in exportdir, and never a live log
+        filename = os.path.basename(args.strip()) or exportfile
+        if filename in (os.curdir, os.pardir):
+            return 'Give a file name to export to, like {}'.format(exportfile)
+        path = os.path.join(exportdir, filename)
+        if os.path.realpath(path) in [os.path.realpath(logpath) for logpath in self.recorders]:
+            return 'Cannot export over the session log {}'.format(path)
+        if not os.path.isdir(exportdir):
+            os.makedirs(exportdir)
+        count = route.recorder.export(path)
+        return 'Exported {} heckles to {}'.format(count, path)
+
+    @botcmd
+    def heckles_stats(self, message, args):
+        """Show the relay's queue depth, drops and enqueue-to-ack latency"""
+        route = self.route_for(message)
+        if route is None:
+            return 'Say this in the channel whose screening you want stats for'
+        stats = route.relay.stats()
+        lines = [
+            'Player at {}:{}: {}'.format(route.relay.host, route.relay.port,
+                                         'connected' if stats['connected'] else 'not connected'),
+            'Queued: {queued} total, {depth} waiting, {inflight} awaiting a position'.format(**stats),
+            'Dropped: {dropped}, acknowledged: {acked}'.format(**stats),
+            'Rate limited: {} passed, {} merged into held lines, {} people held'.format(
+                self.limiter.passed, self.limiter.merged, len(self.limiter.held)),
+        ]
+        latencies = stats['latencies']
+        if latencies:
+            def percentile(fraction):
+                return latencies[min(int(len(latencies) * fraction), len(latencies) - 1)] * 1000
+            lines.append('Enqueue to ack over the last {}: median {:.1f} ms, 95% {:.1f} ms, max {:.1f} ms'.format(
+                len(latencies), percentile(0.5), percentile(0.95), latencies[-1] * 1000))
+        return '\n'.join(lines)
 
 #   def callback_botmessage(self, message):
 #       """Triggered for every message that comes from the bot itself
@@ -121,3 +689,38 @@ class MrHeckles(BotPlugin):
 #   def example(self, mess, args):
 #       """A command which simply returns 'Example'"""
 #       return "Example"
+
+if __name__ == '__main__':
+    # Time normalizing a recorded session (heckles.jsonl or an export) the
+    # old way, transliterating every whole message, against the new one:
+    #     python mrheckles.py heckles.jsonl
+    import timeit
+
+    with open(sys.argv[1], 'r') as fd:
+        data = fd.read().decode('utf-8')
+    if data.lstrip().startswith(u'['):
+        quotes = json.loads(data)
+    else:
+        quotes = [json.loads(line) for line in data.splitlines() if line.strip()]
+    # The log holds what the player showed; turn it back into Slack bodies
+    bodies = [re.sub(u'^<([^>]*)>', u'&lt;\\1&gt;', quote['text']) for quote in quotes]
+
+    def old():
+        for body in bodies:
+            msgbody = unidecode.unidecode(body)
+            fakename = re.split(r'^&lt;(.*)&gt;(.*)', msgbody)
+            if len(fakename) == 4:
+                '<{}> {}'.format(fakename[1], fakename[2].strip())
+
+    def new(transliterating):
+        normalize, normalize_name = normalizers(transliterating)
+        def run():
+            for body in bodies:
+                fakename = fakename_pattern.match(body)
+                if fakename:
+                    style.format(name=normalize_name(fakename.group(1)), text=normalize(fakename.group(2).strip()))
+        return run
+
+    for name, func in (('old', old), ('transliterate', new(True)), ('keep unicode', new(False))):
+        best = min(timeit.repeat(func, number=10, repeat=5)) / 10
+        print '{:>14}: {:.2f} us/message over {} messages'.format(name, best / len(bodies) * 1e6, len(bodies))
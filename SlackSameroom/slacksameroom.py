@@ -1,11 +1,20 @@
 from __future__ import absolute_import
-import json
 import logging
 import re
+import select
+import threading
 import time
 import sys
 import pprint
 
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+import requests
+from requests.adapters import HTTPAdapter
+
 from errbot.backends.base import Message, Presence, ONLINE, AWAY, MUCRoom, RoomError, RoomDoesNotExistError, \
     UserDoesNotExistError, Identifier, MUCIdentifier
 from errbot.errBot import ErrBot
@@ -20,6 +29,10 @@ try:
     from functools import lru_cache
 except ImportError:
     from backports.functools_lru_cache import lru_cache
+try:
+    from time import monotonic
+except ImportError:
+    from monotonic import monotonic
 try:
     from slackclient import SlackClient
 except ImportError:
@@ -53,6 +66,61 @@ SLACK_CLIENT_CHANNEL_HYPERLINK = re.compile(ur'^<#(?P<id>(C|G)[0-9A-Z]+)>$')
 # Empirically determined message size limit.
 SLACK_MESSAGE_LIMIT = 4096
 
+# Bounds (in seconds) for how long serve_once waits on an idle RTM
+# websocket before waking up again. The wait starts at the lower bound
+# and doubles each time nothing arrives, so a quiet room costs next to
+# no CPU while a busy one is dispatched as soon as a frame lands.
+RTM_IDLE_TIMEOUT_MIN = 0.05
+RTM_IDLE_TIMEOUT_MAX = 2.0
+
+SLACK_API_URL = u'https://slack.com/api/%s'
+
+# Defaults for the Web API connection pool, overridable through the
+# api_pool_size and api_timeout keys of BOT_IDENTITY. The timeout is
+# either a single number or a (connect, read) tuple, as in requests.
+SLACK_API_POOL_SIZE = 4
+SLACK_API_TIMEOUT = (5, 30)
+
+# How long (in seconds) channel/group listings and infos are cached before
+# being fetched again, overridable through the api_cache_ttl key of
+# BOT_IDENTITY. RTM channel events invalidate entries early.
+SLACK_API_CACHE_TTL = 300
+
+# Message subtypes which change what channels.info/groups.info return
+CHANNEL_CHANGE_SUBTYPES = frozenset((
+    u'channel_join', u'channel_leave', u'channel_topic', u'channel_purpose',
+    u'channel_name', u'channel_archive', u'channel_unarchive',
+    u'group_join', u'group_leave', u'group_topic', u'group_purpose',
+    u'group_name', u'group_archive', u'group_unarchive',
+))
+
+# Local port serving the backend's metrics in the Prometheus text format,
+# overridable through the metrics_port key of BOT_IDENTITY (0 turns it off),
+# and the upper bounds (in seconds) of the timing histograms' buckets.
+SLACK_METRICS_PORT = 9108
+SLACK_METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+SLACK_METRICS_HELP = {
+    u'slack_events_total': u'RTM events received, by type',
+    u'slack_dispatch_seconds': u'Time spent in each RTM event handler',
+    u'slack_handler_errors_total': u'RTM event handlers that raised an exception',
+    u'slack_api_calls_total': u'Web API calls, by method and error code (empty when ok)',
+    u'slack_api_seconds': u'Web API call latency, by method',
+    u'slack_api_cache_hits_total': u'Channel listings and infos served from the cache',
+    u'slack_api_cache_misses_total': u'Channel listings and infos fetched from the API',
+    u'slack_rtm_connects_total': u'RTM connection attempts, by result',
+    u'slack_rtm_disconnects_total': u'RTM connections lost or closed',
+}
+
+# RTM event types only logged one time in N at DEBUG, since they arrive far
+# more often than anything else, overridable (and extendable) through the
+# debug_sample key of BOT_IDENTITY. 0 never logs that type, 1 logs all.
+SLACK_DEBUG_SAMPLE = {
+    u'presence_change': 50,
+    u'user_typing': 50,
+    u'pong': 0,
+}
+
 USER_IS_BOT_HELPTEXT = (
     u"Connected to Slack using a bot account, which cannot manage "
     u"channels itself (you must invite the bot to channels instead, "
@@ -78,12 +146,262 @@ class SlackAPIResponseError(RuntimeError):
         super(SlackAPIResponseError, self).__init__(*args, **kwargs)
 
 
+class SlackDirectory(object):
+    u"""
+    Dictionary-backed index of the users and channels the bot knows about.
+
+    SlackClient keeps these in plain lists which have to be scanned for every
+    lookup. The directory is rebuilt from them on each RTM connect and kept
+    current from RTM events afterwards, so id/name conversions are O(1).
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self._usernames = {}
+        self._userids = {}
+        self._fullnames = {}
+        self._channelnames = {}
+        self._channelids = {}
+
+    def load(self, server):
+        u"""Rebuild the index from a connected SlackClient server"""
+        self.clear()
+        for user in server.users:
+            self.add_user(user.id, user.name, user.real_name)
+        for channel in server.channels:
+            self.add_channel(channel.id, channel.name)
+
+    def add_user(self, id_, name, real_name=None):
+        old_name = self._usernames.get(id_)
+        if old_name is not None and old_name != name:
+            self._userids.pop(old_name, None)
+        self._usernames[id_] = name
+        self._userids[name] = id_
+        self._fullnames[id_] = real_name if real_name is not None else name
+
+    def add_channel(self, id_, name):
+        old_name = self._channelnames.get(id_)
+        if old_name is not None and old_name != name:
+            self._channelids.pop(old_name, None)
+        self._channelnames[id_] = name
+        self._channelids[name] = id_
+
+    def username(self, id_):
+        return self._usernames.get(id_)
+
+    def fullname(self, id_):
+        return self._fullnames.get(id_)
+
+    def userid(self, name):
+        return self._userids.get(name)
+
+    def channelname(self, id_):
+        return self._channelnames.get(id_)
+
+    def channelid(self, name):
+        return self._channelids.get(name)
+
+
+class SlackAPICache(object):
+    u"""
+    Time-limited cache for slow-changing Slack API responses.
+
+    Channel listings are keyed on the API method and its arguments, channel
+    infos on the channel ID. Hit and miss counts are kept for diagnostics.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._listings = {}
+        self._infos = {}
+
+    def _get(self, entries, key, fetch):
+        entry = entries.get(key)
+        now = time.time()
+        if entry is not None and entry[0] > now:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        value = fetch()
+        entries[key] = (now + self.ttl, value)
+        return value
+
+    def listing(self, key, fetch):
+        u"""Return the cached listing for key, calling fetch() to refresh it"""
+        return self._get(self._listings, key, fetch)
+
+    def info(self, channelid, fetch):
+        u"""Return the cached info for channelid, calling fetch() to refresh it"""
+        return self._get(self._infos, channelid, fetch)
+
+    def invalidate(self, channelid=None):
+        u"""
+        Drop all listings, plus the info for channelid (or every info if
+        no channelid is given).
+        """
+        self._listings.clear()
+        if channelid is None:
+            self._infos.clear()
+        else:
+            self._infos.pop(channelid, None)
+
+
+class SlackMetrics(object):
+    u"""
+    Thread-safe counters and histograms, rendered in the Prometheus text
+    exposition format.
+
+    Counters and histograms are keyed on a name plus label keyword
+    arguments. Counters kept elsewhere can be exported by registering a
+    function returning their current value.
+    """
+
+    def __init__(self, buckets=SLACK_METRICS_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._callbacks = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    def register(self, name, callback):
+        u"""Export callback() as the counter called name"""
+        self._callbacks[name] = callback
+
+    @staticmethod
+    def _labels(labels, **extra):
+        labels = list(labels) + sorted(extra.items())
+        if not labels:
+            return u''
+        return u'{%s}' % u','.join(
+            u'%s="%s"' % (key, unicode(value).replace(u'\\', u'\\\\').replace(u'"', u'\\"').replace(u'\n', u'\\n'))
+            for key, value in labels)
+
+    def _header(self, lines, name, type_):
+        lines.append(u'# HELP %s %s' % (name, SLACK_METRICS_HELP.get(name, name)))
+        lines.append(u'# TYPE %s %s' % (name, type_))
+
+    def render(self):
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, (list(buckets), total, count))
+                                for key, (buckets, total, count) in self._histograms.items())
+        for name, callback in sorted(self._callbacks.items()):
+            counters.append(((name, ()), callback()))
+
+        previous = None
+        for (name, labels), value in counters:
+            if name != previous:
+                self._header(lines, name, u'counter')
+                previous = name
+            lines.append(u'%s%s %s' % (name, self._labels(labels), value))
+        previous = None
+        for (name, labels), (buckets, total, count) in histograms:
+            if name != previous:
+                self._header(lines, name, u'histogram')
+                previous = name
+            for bound, cumulative in zip(self.buckets, buckets):
+                lines.append(u'%s_bucket%s %d' % (name, self._labels(labels, le=repr(bound)), cumulative))
+            lines.append(u'%s_bucket%s %d' % (name, self._labels(labels, le=u'+Inf'), count))
+            lines.append(u'%s_sum%s %r' % (name, self._labels(labels), total))
+            lines.append(u'%s_count%s %d' % (name, self._labels(labels), count))
+        return u'\n'.join(lines) + u'\n'
+
+
+class LazyPformat(object):
+    u"""Pretty-prints a value only when it is actually formatted into a log line"""
+    __slots__ = (u'value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return pprint.pformat(self.value)
+
+    def __unicode__(self):
+        return pprint.pformat(self.value).decode(u'utf-8')
+
+
+class SlackEventLogger(object):
+    u"""
+    DEBUG logging for RTM events.
+
+    sample() decides once per event whether it is logged, and every debug()
+    call until the next event follows that decision. Nothing is formatted
+    unless DEBUG is enabled, events are pretty-printed only if the line is
+    emitted, and the event type is attached to the record as
+    slack_event_type for handlers and formatters to use.
+    """
+
+    def __init__(self, sample=None):
+        self.sample_rates = dict(SLACK_DEBUG_SAMPLE, **(sample or {}))
+        self.seen = {}
+        self.event_type = None
+        self.enabled = False
+
+    def sample(self, event_type):
+        self.event_type = event_type
+        self.enabled = False
+        if not log.isEnabledFor(logging.DEBUG):
+            return False
+        every = self.sample_rates.get(event_type, 1)
+        if every != 1:
+            seen = self.seen[event_type] = self.seen.get(event_type, 0) + 1
+            if not every or (seen - 1) % every:
+                return False
+        self.enabled = True
+        return True
+
+    def debug(self, msg, event):
+        if self.enabled:
+            log.debug(msg, LazyPformat(event), extra={'slack_event_type': self.event_type})
+
+
+class SlackMetricsHandler(BaseHTTPRequestHandler):
+    u"""Serves SlackMetrics.render() at / and /metrics"""
+
+    def do_GET(self):
+        if self.path.split(u'?')[0] not in (u'/', u'/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode(u'utf-8')
+        self.send_response(200)
+        self.send_header(u'Content-Type', u'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header(u'Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug(u"Metrics request from %s: " + format, self.client_address[0], *args)
+
+
 class SlackIdentifier(Identifier):
     u"""
     This class describes a person on Slack's network.
     """
 
-    def __init__(self, sc, userid=None, channelid=None):
+    def __init__(self, sc, userid=None, channelid=None, directory=None):
         if userid is not None and userid[0] not in (u'U', u'B'):
             raise Exception(u'This is not a Slack user or bot id: %s (should start with U or B)' % userid)
 
@@ -93,6 +411,7 @@ class SlackIdentifier(Identifier):
         self._userid = userid
         self._channelid = channelid
         self._sc = sc
+        self._directory = directory
 
     @property
     def userid(self):
@@ -101,9 +420,13 @@ class SlackIdentifier(Identifier):
     @property
     def username(self):
         u"""Convert a Slack user ID to their user name"""
+        if self._directory is not None:
+            name = self._directory.username(self._userid)
+            if name is not None:
+                return name
         user = self._sc.server.users.find(self._userid)
         if user is None:
-            log.error(u"Cannot find user with ID %s" % self._userid)
+            log.error(u"Cannot find user with ID %s", self._userid)
             return u"<%s>" % self._userid
         return user.name
 
@@ -117,6 +440,10 @@ class SlackIdentifier(Identifier):
         if self._channelid is None:
             return None
 
+        if self._directory is not None:
+            name = self._directory.channelname(self._channelid)
+            if name is not None:
+                return name
         channel = self._sc.server.channels.find(self._channelid)
         if channel is None:
             raise RoomDoesNotExistError(u"No channel with ID %s exists" % self._channelid)
@@ -141,9 +468,13 @@ class SlackIdentifier(Identifier):
     @property
     def fullname(self):
         u"""Convert a Slack user ID to their user name"""
+        if self._directory is not None:
+            name = self._directory.fullname(self._userid)
+            if name is not None:
+                return name
         user = self._sc.server.users.find(self._userid)
         if user is None:
-            log.error(u"Cannot find user with ID %s" % self._userid)
+            log.error(u"Cannot find user with ID %s", self._userid)
             return u"<%s>" % self._userid
         return user.real_name
 
@@ -180,13 +511,51 @@ class SlackBackend(ErrBot):
             )
             sys.exit(1)
         self.sc = None  # Will be initialized in serve_once
+        self.directory = SlackDirectory()
+        self.api_cache = SlackAPICache(identity.get(u'api_cache_ttl', SLACK_API_CACHE_TTL))
+        self.api_timeout = identity.get(u'api_timeout', SLACK_API_TIMEOUT)
+        if isinstance(self.api_timeout, list):
+            # requests only takes a (connect, read) pair as a tuple
+            self.api_timeout = tuple(self.api_timeout)
+        # One keep-alive session for every Web API call, so back to back
+        # room-management calls reuse connections instead of redoing the
+        # TCP and TLS handshakes each time.
+        self.http = requests.Session()
+        self.http.mount(u'https://', HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=identity.get(u'api_pool_size', SLACK_API_POOL_SIZE)
+        ))
         self.md = imtext()
+        self.metrics = SlackMetrics()
+        self.metrics.register(u'slack_api_cache_hits_total', lambda: self.api_cache.hits)
+        self.metrics.register(u'slack_api_cache_misses_total', lambda: self.api_cache.misses)
+        self.metrics_port = identity.get(u'metrics_port', SLACK_METRICS_PORT)
+        self.metrics_server = None
+        self.event_log = SlackEventLogger(identity.get(u'debug_sample'))
+
+    def _start_metrics_server(self):
+        u"""Serve self.metrics on localhost:metrics_port from a daemon thread"""
+        if self.metrics_server is not None or not self.metrics_port:
+            return
+        try:
+            self.metrics_server = HTTPServer((u'127.0.0.1', self.metrics_port), SlackMetricsHandler)
+        except Exception:
+            log.exception(u"Could not serve metrics on port %s", self.metrics_port)
+            self.metrics_port = None
+            return
+        self.metrics_server.metrics = self.metrics
+        thread = threading.Thread(target=self.metrics_server.serve_forever, name=u'SlackMetrics')
+        thread.daemon = True
+        thread.start()
+        log.info(u"Serving metrics at http://127.0.0.1:%s/metrics", self.metrics_port)
 
     def api_call(self, method, data=None, raise_errors=True):
         u"""
         Make an API call to the Slack API and return response data.
 
-        This is a thin wrapper around `SlackClient.server.api_call`.
+        Requests go through the backend's pooled keep-alive session rather
+        than `SlackClient.server.api_call`, which opens a new connection
+        every time.
 
         :param method:
             The API method to invoke (see https://api.slack.com/methods/).
@@ -203,7 +572,19 @@ class SlackBackend(ErrBot):
         """
         if data is None:
             data = {}
-        response = json.loads(self.sc.server.api_call(method, **data).decode(u'utf-8'))
+        started = monotonic()
+        try:
+            response = self.http.post(
+                SLACK_API_URL % method,
+                data=dict(data, token=self.token),
+                timeout=self.api_timeout
+            ).json()
+        except Exception as e:
+            self.metrics.inc(u'slack_api_calls_total', method=method, error=e.__class__.__name__)
+            raise
+        finally:
+            self.metrics.observe(u'slack_api_seconds', monotonic() - started, method=method)
+        self.metrics.inc(u'slack_api_calls_total', method=method, error=response.get(u'error', u''))
         if raise_errors and not response[u'ok']:
             raise SlackAPIResponseError(
                 u"Slack API call to %s failed: %s" % (method, response[u'error']),
@@ -212,62 +593,111 @@ class SlackBackend(ErrBot):
         return response
 
     def serve_once(self):
+        self._start_metrics_server()
         self.sc = SlackClient(self.token)
         log.info(u"Verifying authentication token")
         self.auth = self.api_call(u"auth.test", raise_errors=False)
         if not self.auth[u'ok']:
             raise SlackAPIResponseError(error=u"Couldn't authenticate with Slack. Server said: %s" % self.auth[u'error'])
         log.debug(u"Token accepted")
-        self.bot_identifier = SlackIdentifier(self.sc, self.auth[u"user_id"])
+        self.bot_identifier = SlackIdentifier(self.sc, self.auth[u"user_id"], directory=self.directory)
 
         log.info(u"Connecting to Slack real-time-messaging API")
         if self.sc.rtm_connect():
+            self.metrics.inc(u'slack_rtm_connects_total', result=u'ok')
             log.info(u"Connected")
+            self.directory.load(self.sc.server)
+            # Anything could have changed while we were disconnected
+            self.api_cache.invalidate()
             self.reset_reconnection_count()
             try:
+                idle_timeout = RTM_IDLE_TIMEOUT_MIN
                 while True:
-                    for message in self.sc.rtm_read():
-                        self._dispatch_slack_message(message)
-                    time.sleep(1)
+                    messages = self.sc.rtm_read()
+                    if messages:
+                        for message in messages:
+                            self._dispatch_slack_message(message)
+                        idle_timeout = RTM_IDLE_TIMEOUT_MIN
+                        continue
+                    self._wait_for_rtm_frame(idle_timeout)
+                    idle_timeout = min(idle_timeout * 2, RTM_IDLE_TIMEOUT_MAX)
             except KeyboardInterrupt:
                 log.info(u"Interrupt received, shutting down..")
                 return True
             except:
                 log.exception(u"Error reading from RTM stream:")
             finally:
+                self.metrics.inc(u'slack_rtm_disconnects_total')
                 log.debug(u"Triggering disconnect callback")
                 self.disconnect_callback()
         else:
+            self.metrics.inc(u'slack_rtm_connects_total', result=u'failed')
             raise Exception(u'Connection failed, invalid token ?')
 
+    def _wait_for_rtm_frame(self, timeout):
+        u"""
+        Block until the RTM websocket has data to read or `timeout` expires.
+
+        SlackClient puts the websocket in non-blocking mode, so without this
+        rtm_read would have to be polled. Data already decrypted and buffered
+        by the SSL layer is invisible to select, so check for that first.
+        """
+        sock = getattr(self.sc.server.websocket, u'sock', None)
+        if sock is None:
+            time.sleep(timeout)
+            return
+        if hasattr(sock, u'pending') and sock.pending():
+            return
+        select.select([sock], [], [], timeout)
+
     def _dispatch_slack_message(self, message):
         u"""
         Process an incoming message from slack.
 
         """
         if u'type' not in message:
-            log.debug(u"Ignoring non-event message: %s" % message)
+            log.debug(u"Ignoring non-event message: %s", message)
             return
 
         event_type = message[u'type']
+        self.metrics.inc(u'slack_events_total', type=event_type)
+        self.event_log.sample(event_type)
 
         event_handlers = {
             u'hello': self._hello_event_handler,
             u'presence_change': self._presence_change_event_handler,
-            u'team_join': self._team_join_event_handler,
+            u'team_join': self._user_event_handler,
+            u'user_change': self._user_event_handler,
+            u'channel_created': self._channel_event_handler,
+            u'channel_rename': self._channel_event_handler,
+            u'channel_joined': self._channel_event_handler,
+            u'group_joined': self._channel_event_handler,
+            u'group_rename': self._channel_event_handler,
+            u'channel_deleted': self._channel_state_event_handler,
+            u'channel_left': self._channel_state_event_handler,
+            u'channel_archive': self._channel_state_event_handler,
+            u'channel_unarchive': self._channel_state_event_handler,
+            u'group_left': self._channel_state_event_handler,
+            u'group_archive': self._channel_state_event_handler,
+            u'group_unarchive': self._channel_state_event_handler,
             u'message': self._message_event_handler,
         }
 
         event_handler = event_handlers.get(event_type)
 
         if event_handler is None:
-            log.debug(u"No event handler available for %s, ignoring this event" % event_type)
+            self.event_log.debug(u"No event handler available, ignoring this event: %s", message)
             return
+        handler_name = event_handler.__name__
+        started = monotonic()
         try:
-            log.debug(u"Processing slack event: %s" % message)
+            self.event_log.debug(u"Processing slack event: %s", message)
             event_handler(message)
         except Exception:
-            log.exception(u"%s event handler raised an exception" % event_type)
+            self.metrics.inc(u'slack_handler_errors_total', handler=handler_name)
+            log.exception(u"%s event handler raised an exception", event_type)
+        finally:
+            self.metrics.observe(u'slack_dispatch_seconds', monotonic() - started, handler=handler_name)
 
     def _hello_event_handler(self, event):
         u"""Event handler for the 'hello' event"""
@@ -277,7 +707,7 @@ class SlackBackend(ErrBot):
     def _presence_change_event_handler(self, event):
         u"""Event handler for the 'presence_change' event"""
 
-        idd = SlackIdentifier(self.sc, event[u'user'])
+        idd = SlackIdentifier(self.sc, event[u'user'], directory=self.directory)
         presence = event[u'presence']
         # According to https://api.slack.com/docs/presence, presence can
         # only be one of 'active' and 'away'
@@ -287,16 +717,39 @@ class SlackBackend(ErrBot):
             status = AWAY
         else:
             log.error(
-                u"It appears the Slack API changed, I received an unknown presence type %s" % presence
+                u"It appears the Slack API changed, I received an unknown presence type %s", presence
             )
             status = ONLINE
         self.callback_presence(Presence(identifier=idd, status=status))
 
-    def _team_join_event_handler(self, event):
-        self.sc.parse_user_data((event[u'user'],))
+    def _user_event_handler(self, event):
+        u"""Event handler for the 'team_join' and 'user_change' events"""
+        user = event[u'user']
+        real_name = user.get(u'real_name') or user.get(u'profile', {}).get(u'real_name') or user[u'name']
+        # SlackClient attaches new users itself but never updates existing ones
+        known = self.sc.server.users.find(user[u'id'])
+        if known is not None:
+            known.name = user[u'name']
+            known.real_name = real_name
+        self.directory.add_user(user[u'id'], user[u'name'], real_name)
+
+    def _channel_event_handler(self, event):
+        u"""Event handler for channel and group creation, join and rename events"""
+        channel = event[u'channel']
+        # SlackClient attaches new channels itself but never renames them
+        known = self.sc.server.channels.find(channel[u'id'])
+        if known is not None:
+            known.name = channel[u'name']
+        self.directory.add_channel(channel[u'id'], channel[u'name'])
+        self.api_cache.invalidate(channel[u'id'])
+
+    def _channel_state_event_handler(self, event):
+        u"""Event handler for channel and group leave, archive and delete events"""
+        self.api_cache.invalidate(event[u'channel'])
 
     def _message_event_handler(self, event):
         u"""Event handler for the 'message' event"""
+        received = monotonic()
         channel = event[u'channel']
         if channel.startswith(u'C'):
             log.debug(u"Handling message from a public channel")
@@ -315,6 +768,8 @@ class SlackBackend(ErrBot):
         if subtype == u"message_deleted":
             log.debug(u"Message of type message_deleted, ignoring this event")
             return
+        if subtype in CHANNEL_CHANGE_SUBTYPES:
+            self.api_cache.invalidate(channel)
         if subtype == u"message_changed" and u'attachments' in event[u'message']:
             # If you paste a link into Slack, it does a call-out to grab details
             # from it so it can display this in the chatroom. These show up as
@@ -339,58 +794,67 @@ class SlackBackend(ErrBot):
 
         text = re.sub(u"<[^>]*>", self.remove_angle_brackets_from_uris, text)
 
-        log.debug(u"Saw an event: %s" % pprint.pformat(event))
+        self.event_log.debug(u"Saw an event: %s", event)
 
         msg = Message(
             text,
             type_=message_type,
             extras={u'attachments': event.get(u'attachments')})
 
+        # For latency tracing: when the event reached us, on the monotonic
+        # clock shared by processes on this machine, and how long after
+        # Slack timestamped it (subject to clock skew)
+        msg.extras[u'received_at'] = received
+        try:
+            msg.extras[u'slack_lag'] = max(time.time() - float(event.get(u'ts', u'')), 0.0)
+        except ValueError:
+            pass
+
         # sameroom.io bots don't include user or bot ids, handle this specially
         if subtype == u'bot_message' and not user:
             msg.extras[u'sameroom_bot'] = True
             msg.extras[u'sameroom_username'] = event.get(u'username', None)
 
         if message_type == u'chat':
-            msg.frm = SlackIdentifier(self.sc, user, event[u'channel'])
-            msg.to = SlackIdentifier(self.sc, self.username_to_userid(self.sc.server.username),
-                                     event[u'channel'])
+            msg.frm = SlackIdentifier(self.sc, user, event[u'channel'], directory=self.directory)
+            msg.to = SlackIdentifier(self.sc, self.bot_identifier.userid, event[u'channel'],
+                                     directory=self.directory)
         else:
-            msg.frm = SlackMUCOccupant(self.sc, user, event[u'channel'])
-            msg.to = SlackMUCOccupant(self.sc, self.username_to_userid(self.sc.server.username),
-                                      event[u'channel'])
+            msg.frm = SlackMUCOccupant(self.sc, user, event[u'channel'], directory=self.directory)
+            msg.to = SlackMUCOccupant(self.sc, self.bot_identifier.userid, event[u'channel'],
+                                      directory=self.directory)
 
         self.callback_message(msg)
 
     def userid_to_username(self, id_):
         u"""Convert a Slack user ID to their user name"""
-        user = [user for user in self.sc.server.users if user.id == id_]
-        if not user:
+        name = self.directory.username(id_)
+        if name is None:
             raise UserDoesNotExistError(u"Cannot find user with ID %s" % id_)
-        return user[0].name
+        return name
 
     def username_to_userid(self, name):
         u"""Convert a Slack user name to their user ID"""
-        user = [user for user in self.sc.server.users if user.name == name]
-        if not user:
+        id_ = self.directory.userid(name)
+        if id_ is None:
             raise UserDoesNotExistError(u"Cannot find user %s" % name)
-        return user[0].id
+        return id_
 
     def channelid_to_channelname(self, id_):
         u"""Convert a Slack channel ID to its channel name"""
-        channel = [channel for channel in self.sc.server.channels if channel.id == id_]
-        if not channel:
+        name = self.directory.channelname(id_)
+        if name is None:
             raise RoomDoesNotExistError(u"No channel with ID %s exists" % id_)
-        return channel[0].name
+        return name
 
     def channelname_to_channelid(self, name):
         u"""Convert a Slack channel name to its channel ID"""
         if name.startswith(u'#'):
             name = name[1:]
-        channel = [channel for channel in self.sc.server.channels if channel.name == name]
-        if not channel:
+        id_ = self.directory.channelid(name)
+        if id_ is None:
             raise RoomDoesNotExistError(u"No channel named %s exists" % name)
-        return channel[0].id
+        return id_
 
     def channels(self, exclude_archived=True, joined_only=False):
         u"""
@@ -408,11 +872,17 @@ class SlackBackend(ErrBot):
           * https://api.slack.com/methods/channels.list
           * https://api.slack.com/methods/groups.list
         """
-        response = self.api_call(u'channels.list', data={u'exclude_archived': exclude_archived})
+        response = self.api_cache.listing(
+            (u'channels.list', exclude_archived),
+            lambda: self.api_call(u'channels.list', data={u'exclude_archived': exclude_archived})
+        )
         channels = [channel for channel in response[u'channels']
                     if channel[u'is_member'] or not joined_only]
 
-        response = self.api_call(u'groups.list', data={u'exclude_archived': exclude_archived})
+        response = self.api_cache.listing(
+            (u'groups.list', exclude_archived),
+            lambda: self.api_call(u'groups.list', data={u'exclude_archived': exclude_archived})
+        )
         # No need to filter for 'is_member' in this next call (it doesn't
         # (even exist) because leaving a group means you have to get invited
         # back again by somebody else.
@@ -420,6 +890,24 @@ class SlackBackend(ErrBot):
 
         return channels + groups
 
+    def channel_info(self, id_):
+        u"""
+        Get information about a single channel or group.
+
+        :returns:
+            A channel (https://api.slack.com/types/channel) or group
+            (https://api.slack.com/types/group) type.
+
+        See also:
+          * https://api.slack.com/methods/channels.info
+          * https://api.slack.com/methods/groups.info
+        """
+        if id_.startswith(u'G'):
+            return self.api_cache.info(
+                id_, lambda: self.api_call(u'groups.info', data={u'channel': id_})[u'group'])
+        return self.api_cache.info(
+            id_, lambda: self.api_call(u'channels.info', data={u'channel': id_})[u'channel'])
+
     @lru_cache(50)
     def get_im_channel(self, id_):
         u"""Open a direct message channel to a user"""
@@ -439,9 +927,9 @@ class SlackBackend(ErrBot):
                 if to_channel_id.startswith(u'C'):
                     log.debug(u"This is a divert to private message, sending it directly to the user.")
                     to_channel_id = self.get_im_channel(self.username_to_userid(to_humanreadable))
-            log.debug(u'Sending %s message to %s (%s)' % (mess.type, to_humanreadable, to_channel_id))
+            log.debug(u'Sending %s message to %s (%s)', mess.type, to_humanreadable, to_channel_id)
             body = self.md.convert(mess.body)
-            log.debug(u'Message size: %d' % len(body))
+            log.debug(u'Message size: %d', len(body))
 
             limit = min(self.bot_config.MESSAGE_SIZE_LIMIT, SLACK_MESSAGE_LIMIT)
             parts = self.prepare_message_body(body, limit)
@@ -451,7 +939,7 @@ class SlackBackend(ErrBot):
         except Exception:
             log.exception(
                 u"An exception occurred while trying to send the following message "
-                u"to %s: %s" % (to_humanreadable, mess.body)
+                u"to %s: %s", to_humanreadable, mess.body
             )
 
     def change_presence(self, status = ONLINE, message = u''):
@@ -557,19 +1045,19 @@ class SlackBackend(ErrBot):
         Supports strings with the formats accepted by
         :func:`~extract_identifiers_from_string`.
         """
-        log.debug(u"building an identifier from %s" % txtrep)
+        log.debug(u"building an identifier from %s", txtrep)
         username, userid, channelname, channelid = self.extract_identifiers_from_string(txtrep)
 
         if userid is not None:
-            return SlackIdentifier(self.sc, userid, self.get_im_channel(userid))
+            return SlackIdentifier(self.sc, userid, self.get_im_channel(userid), directory=self.directory)
         if channelid is not None:
-            return SlackIdentifier(self.sc, None, channelid)
+            return SlackIdentifier(self.sc, None, channelid, directory=self.directory)
         if username is not None:
             userid = self.username_to_userid(username)
-            return SlackIdentifier(self.sc, userid, self.get_im_channel(userid))
+            return SlackIdentifier(self.sc, userid, self.get_im_channel(userid), directory=self.directory)
         if channelname is not None:
             channelid = self.channelname_to_channelid(channelname)
-            return SlackMUCOccupant(self.sc, userid, channelid)
+            return SlackMUCOccupant(self.sc, userid, channelid, directory=self.directory)
 
         raise Exception(
             u"You found a bug. I expected at least one of userid, channelid, username or channelname "
@@ -587,6 +1075,10 @@ class SlackBackend(ErrBot):
         return response
 
     def shutdown(self):
+        self.http.close()
+        if self.metrics_server is not None:
+            self.metrics_server.shutdown()
+            self.metrics_server.server_close()
         super(SlackBackend, self).shutdown()
 
     @deprecated
@@ -668,10 +1160,7 @@ class SlackRoom(MUCRoom):
           * https://api.slack.com/methods/channels.list
           * https://api.slack.com/methods/groups.list
         """
-        if self.private:
-            return self._bot.api_call(u'groups.info', data={u'channel': self.id})[u"group"]
-        else:
-            return self._bot.api_call(u'channels.info', data={u'channel': self.id})[u"channel"]
+        return self._bot.channel_info(self.id)
 
     @property
     def private(self):
@@ -691,7 +1180,7 @@ class SlackRoom(MUCRoom):
         return self._name
 
     def join(self, username=None, password=None):
-        log.info(u"Joining channel %s" % unicode(self))
+        log.info(u"Joining channel %s", unicode(self))
         try:
             self._bot.api_call(u'channels.join', data={u'name': self.name})
         except SlackAPIResponseError, e:
@@ -699,49 +1188,53 @@ class SlackRoom(MUCRoom):
                 raise RoomError(u"Unable to join channel. " + USER_IS_BOT_HELPTEXT)
             else:
                 raise RoomError(e)
+        self._bot.api_cache.invalidate(self._id)
 
     def leave(self, reason=None):
         try:
             if self.id.startswith(u'C'):
-                log.info(u"Leaving channel %s (%s)" % (unicode(self), self.id))
+                log.info(u"Leaving channel %s (%s)", unicode(self), self.id)
                 self._bot.api_call(u'channels.leave', data={u'channel': self.id})
             else:
-                log.info(u"Leaving group %s (%s)" % (unicode(self), self.id))
+                log.info(u"Leaving group %s (%s)", unicode(self), self.id)
                 self._bot.api_call(u'groups.leave', data={u'channel': self.id})
         except SlackAPIResponseError, e:
             if e.error == u"user_is_bot":
                 raise RoomError(u"Unable to leave channel. " + USER_IS_BOT_HELPTEXT)
             else:
                 raise RoomError(e)
+        self._bot.api_cache.invalidate(self._id)
         self._id = None
 
     def create(self, private=False):
         try:
             if private:
-                log.info(u"Creating group %s" % unicode(self))
+                log.info(u"Creating group %s", unicode(self))
                 self._bot.api_call(u'groups.create', data={u'name': self.name})
             else:
-                log.info(u"Creating channel %s" % unicode(self))
+                log.info(u"Creating channel %s", unicode(self))
                 self._bot.api_call(u'channels.create', data={u'name': self.name})
         except SlackAPIResponseError, e:
             if e.error == u"user_is_bot":
                 raise RoomError(u"Unable to create channel. " + USER_IS_BOT_HELPTEXT)
             else:
                 raise RoomError(e)
+        self._bot.api_cache.invalidate(self._id)
 
     def destroy(self):
         try:
             if self.id.startswith(u'C'):
-                log.info(u"Archiving channel %s (%s)" % (unicode(self), self.id))
+                log.info(u"Archiving channel %s (%s)", unicode(self), self.id)
                 self._bot.api_call(u'channels.archive', data={u'channel': self.id})
             else:
-                log.info(u"Archiving group %s (%s)" % (unicode(self), self.id))
+                log.info(u"Archiving group %s (%s)", unicode(self), self.id)
                 self._bot.api_call(u'groups.archive', data={u'channel': self.id})
         except SlackAPIResponseError, e:
             if e.error == u"user_is_bot":
                 raise RoomError(u"Unable to archive channel. " + USER_IS_BOT_HELPTEXT)
             else:
                 raise RoomError(e)
+        self._bot.api_cache.invalidate(self._id)
         self._id = None
 
     @property
@@ -764,11 +1257,12 @@ class SlackRoom(MUCRoom):
     @topic.setter
     def topic(self, topic):
         if self.private:
-            log.info(u"Setting topic of %s (%s) to '%s'" % (unicode(self), self.id, topic))
+            log.info(u"Setting topic of %s (%s) to '%s'", unicode(self), self.id, topic)
             self._bot.api_call(u'groups.setTopic', data={u'channel': self.id, u'topic': topic})
         else:
-            log.info(u"Setting topic of %s (%s) to '%s'" % (unicode(self), self.id, topic))
+            log.info(u"Setting topic of %s (%s) to '%s'", unicode(self), self.id, topic)
             self._bot.api_call(u'channels.setTopic', data={u'channel': self.id, u'topic': topic})
+        self._bot.api_cache.invalidate(self.id)
 
     @property
     def purpose(self):
@@ -780,23 +1274,25 @@ class SlackRoom(MUCRoom):
     @purpose.setter
     def purpose(self, purpose):
         if self.private:
-            log.info(u"Setting purpose of %s (%s) to '%s'" % (unicode(self), self.id, purpose))
+            log.info(u"Setting purpose of %s (%s) to '%s'", unicode(self), self.id, purpose)
             self._bot.api_call(u'groups.setPurpose', data={u'channel': self.id, u'purpose': purpose})
         else:
-            log.info(u"Setting purpose of %s (%s) to '%s'" % (unicode(self), self.id, purpose))
+            log.info(u"Setting purpose of %s (%s) to '%s'", unicode(self), self.id, purpose)
             self._bot.api_call(u'channels.setPurpose', data={u'channel': self.id, u'purpose': purpose})
+        self._bot.api_cache.invalidate(self.id)
 
     @property
     def occupants(self):
         members = self._channel_info[u'members']
-        return [SlackMUCOccupant(self.sc, self._bot.userid_to_username(m), self._name) for m in members]
+        return [SlackMUCOccupant(self.sc, self._bot.userid_to_username(m), self._name,
+                                 directory=self._bot.directory) for m in members]
 
     def invite(self, *args):
         users = dict((user[u'name'], user[u'id']) for user in self._bot.api_call(u'users.list')[u'members'])
         for user in args:
             if user not in users:
                 raise UserDoesNotExistError(u"User '%s' not found" % user)
-            log.info(u"Inviting %s into %s (%s)" % (user, unicode(self), self.id))
+            log.info(u"Inviting %s into %s (%s)", user, unicode(self), self.id)
             method = u'groups.invite' if self.private else u'channels.invite'
             response = self._bot.api_call(
                 method,
@@ -809,3 +1305,116 @@ class SlackRoom(MUCRoom):
                     raise RoomError(u"Unable to invite people. " + USER_IS_BOT_HELPTEXT)
                 elif response[u'error'] != u"already_in_channel":
                     raise SlackAPIResponseError(error=u"Slack API call to %s failed: %s" % (method, response[u'error']))
+            self._bot.api_cache.invalidate(self.id)
+
+
+def _benchmark_logging():
+    u"""Per-event cost of the DEBUG logging on the message path while the bot
+    runs at INFO, as it normally does"""
+    import timeit
+
+    logging.basicConfig(level=logging.INFO)
+    event = {
+        u'type': u'message', u'channel': u'C024BE91L', u'user': u'U2147483697',
+        u'text': u'<Sameroom> *nice* _plot_ twist, see <http://example.com/|this>',
+        u'ts': u'1355517523.000005', u'team': u'T024BE7LD',
+        u'attachments': [{
+            u'fallback': u'Example link', u'title': u'Example', u'title_link': u'http://example.com/',
+            u'text': u'An example page ' * 8, u'image_url': u'http://example.com/image.png',
+            u'fields': [{u'title': u'Field %d' % i, u'value': u'Value %d' % i, u'short': True} for i in range(6)],
+        }],
+    }
+    event_log = SlackEventLogger()
+
+    def eager():
+        log.debug(u"Saw an event: %s" % pprint.pformat(event))
+
+    def lazy_args():
+        log.debug(u"Saw an event: %s", pprint.pformat(event))
+
+    def lazy():
+        event_log.sample(u'message')
+        event_log.debug(u"Saw an event: %s", event)
+
+    for name, func in ((u'% pformat', eager), (u'pformat arg', lazy_args), (u'SlackEventLogger', lazy)):
+        best = min(timeit.repeat(func, number=10000, repeat=5)) / 10000
+        print(u'{:>16}: {:.2f} us/event'.format(name, best * 1e6))
+
+
+def _benchmark_pool(calls):
+    u"""Count the connections a loopback stub of the Web API accepts over
+    back to back api_calls, against one requests.post per call as before"""
+    try:
+        from socketserver import ThreadingMixIn
+    except ImportError:
+        from SocketServer import ThreadingMixIn
+    global SLACK_API_URL
+
+    class StubServer(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+        connections = 0
+
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # Send each response in one segment, or Nagle and delayed ACKs add
+        # 40 ms to every call on a kept-alive connection
+        wbufsize = -1
+        disable_nagle_algorithm = True
+
+        def setup(self):
+            BaseHTTPRequestHandler.setup(self)
+            self.server.connections += 1
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            body = b'{"ok": true}'
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = StubServer(('127.0.0.1', 0), StubHandler)
+    thread = threading.Thread(target=server.serve_forever, name=u'SlackAPIStub')
+    thread.daemon = True
+    thread.start()
+    SLACK_API_URL = u'http://127.0.0.1:%d/api/%%s' % server.server_address[1]
+
+    # Just what api_call needs, without connecting to Slack
+    backend = SlackBackend.__new__(SlackBackend)
+    backend.token = u'xoxb-stub'
+    backend.api_timeout = SLACK_API_TIMEOUT
+    backend.metrics = SlackMetrics()
+    backend.http = requests.Session()
+    backend.http.mount(u'http://', HTTPAdapter(pool_connections=1, pool_maxsize=SLACK_API_POOL_SIZE))
+
+    def unpooled():
+        for i in range(calls):
+            requests.post(SLACK_API_URL % u'api.test', data={u'token': backend.token},
+                          timeout=SLACK_API_TIMEOUT).json()
+
+    def pooled():
+        for i in range(calls):
+            backend.api_call(u'api.test')
+
+    for name, func in ((u'requests.post', unpooled), (u'api_call', pooled)):
+        server.connections = 0
+        started = monotonic()
+        func()
+        elapsed = monotonic() - started
+        print(u'{:>14}: {} calls, {} connections, {:.2f} ms/call'.format(
+            name, calls, server.connections, elapsed / calls * 1000))
+    backend.http.close()
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    # python slacksameroom.py           times DEBUG logging at INFO
+    # python slacksameroom.py pool [N]  counts Web API connections over N calls
+    if sys.argv[1:2] == [u'pool']:
+        _benchmark_pool(int(sys.argv[2]) if len(sys.argv) > 2 else 100)
+    else:
+        _benchmark_logging()
@@ -11,13 +11,26 @@ from kivy.support import install_twisted_reactor
 from kivy.uix.popup import Popup
 from kivy.uix.filechooser import FileChooserIconView
 from kivy.animation import Animation
+from kivy.clock import Clock
 
 from sys import argv
 import os.path
+import json
+import collections
+
+try:
+    from time import monotonic
+except ImportError:
+    from monotonic import monotonic
+
+from snarkymarkup import slack_to_kivy
 
 install_twisted_reactor()
 from twisted.internet import reactor
 from twisted.internet import protocol
+from twisted.internet.error import CannotListenError
+from twisted.protocols.basic import Int32StringReceiver
+from twisted.web import server, resource
 
 Config.set('graphics', 'width', 800)
 Config.set('graphics','height', 400)
@@ -40,11 +53,106 @@ if os.path.exists(os.path.join(os.path.expanduser('~'), 'Library/Fonts/Monotype
         LabelBase.register(**font)
     UseLucidaFax = True
 
-class EchoProtocol(protocol.Protocol):
-    def dataReceived(self, data):
-        response = self.factory.app.handle_message(data)
-        if response:
-            self.transport.write(response)
+class ChatHistory(object):
+    """The most recent chat lines, capped both by count and by total size
+    in UTF-8 bytes, markup included.
+
+    Only this window is ever handed to the ScrollLabel, so the cost of laying
+    out the transcript stays flat however long the screening runs."""
+
+    def __init__(self, max_lines, max_bytes):
+        self.max_lines = max_lines
+        self.max_bytes = max_bytes
+        self.lines = collections.deque()
+        self.sizes = collections.deque()
+        self.size = 0
+
+    def append(self, line):
+        size = len(line.encode('utf-8')) + 1
+        self.lines.append(line)
+        self.sizes.append(size)
+        self.size += size
+        while len(self.lines) > 1 and (len(self.lines) > self.max_lines or self.size > self.max_bytes):
+            self.lines.popleft()
+            self.size -= self.sizes.popleft()
+
+    @property
+    def text(self):
+        return u"\n".join(self.lines)
+
+class LatencyStats(object):
+    """Rolling percentiles of how long each leg of a heckle's journey took.
+
+    MrHeckles and the Slack backend stamp messages with monotonic times,
+    which are comparable across processes on the same machine; legs that
+    come out negative, as they would between machines, are left out."""
+
+    # (name, start, end) timestamps of each leg; Slack's is a duration
+    LEGS = (
+        ('slack', None, 'slack_lag'),     # Slack's timestamp to the backend
+        ('bot', 'received', 'queued'),    # Errbot dispatch and rate limits
+        ('relay', 'queued', 'sent'),      # MrHeckles' queue and formatting
+        ('network', 'sent', 'arrived'),   # the socket, and the hub if any
+        ('player', 'arrived', 'drawn'),   # coalescing, layout and drawing
+        ('total', 'received', 'drawn'),
+    )
+
+    def __init__(self, samples):
+        self.legs = collections.OrderedDict(
+            (name, collections.deque(maxlen=samples)) for name, start, end in self.LEGS)
+
+    def add(self, timing):
+        for name, start, end in self.LEGS:
+            try:
+                seconds = timing[end] - (timing[start] if start else 0.0)
+            except (KeyError, TypeError):
+                continue
+            if seconds >= 0:
+                self.legs[name].append(seconds)
+
+    def summary(self):
+        """{leg: {count, p50, p95, p99}}, in milliseconds"""
+        summary = collections.OrderedDict()
+        for name, samples in self.legs.items():
+            samples = sorted(samples)
+            if not samples:
+                continue
+            summary[name] = collections.OrderedDict([('count', len(samples))] + [
+                ('p{}'.format(percent), round(samples[min(len(samples) * percent // 100, len(samples) - 1)] * 1000, 1))
+                for percent in (50, 95, 99)])
+        return summary
+
+class StatsResource(resource.Resource):
+    """GET / on the stats port returns the latency summary as JSON"""
+    isLeaf = True
+
+    def __init__(self, app):
+        resource.Resource.__init__(self)
+        self.app = app
+
+    def render_GET(self, request):
+        request.setHeader(b'Content-Type', b'application/json')
+        return json.dumps(self.app.stats(), indent=2).encode('utf-8')
+
+class EchoProtocol(Int32StringReceiver):
+    """Length-prefixed framing, so messages survive TCP splitting and
+    coalescing.  Each frame is a JSON object with a "text" key, and every
+    frame is answered, in order, with the current video position."""
+
+    def stringReceived(self, data):
+        arrived = monotonic()
+        try:
+            message = json.loads(data.decode('utf-8'))
+            msg = message['text']
+            timing = message.get('timing')
+        except (ValueError, KeyError, TypeError, AttributeError):
+            Logger.warning('Snarky: discarding malformed message {!r}'.format(data))
+            self.sendString('')
+            return
+        timing = dict(timing) if isinstance(timing, dict) else {}
+        timing['arrived'] = arrived
+        response = self.factory.app.handle_message(msg, timing)
+        self.sendString(response or '')
 
 class EchoFactory(protocol.Factory):
     protocol = EchoProtocol
@@ -52,6 +160,19 @@ class EchoFactory(protocol.Factory):
     def __init__(self, app):
         self.app = app
 
+class HubClientFactory(protocol.ReconnectingClientFactory):
+    """Subscribes to a snarkyhub.py broadcast hub instead of listening,
+    speaking the same protocol with the roles of the ends reversed."""
+    protocol = EchoProtocol
+    maxDelay = 30
+
+    def __init__(self, app):
+        self.app = app
+
+    def buildProtocol(self, addr):
+        self.resetDelay()
+        return protocol.ReconnectingClientFactory.buildProtocol(self, addr)
+
 kv = """
 DesktopVideoPlayer:
 
@@ -79,6 +200,20 @@ DesktopVideoPlayer:
 """
 
 class SnarkyScreeningApp(App):
+    def build_config(self, config):
+        config.setdefaults('snarky', {
+            'history_lines': 100,
+            'history_bytes': 16384,
+            # host:port of a snarkyhub.py subscriber port; empty to listen
+            # for MrHeckles directly
+            'hub': '',
+            # Latency percentiles are served as JSON on this local port (0
+            # to turn it off) and logged every stats_interval seconds
+            'stats_port': 8081,
+            'stats_interval': 60,
+            'stats_samples': 1000,
+        })
+
     def build(self):
         Config.set('input','mouse', 'mouse,disable_multitouch')
 
@@ -101,30 +236,104 @@ class SnarkyScreeningApp(App):
         if UseLucidaFax:
             self.root.ids.snarky_chatstream.font_name = 'LucidaFax'
             
-        self.root.ids.snarky_chatstream.text += """
+        self.history = ChatHistory(self.config.getint('snarky', 'history_lines'),
+                                   self.config.getint('snarky', 'history_bytes'))
+        self.history.append(u"""
 Welcome to a [b]Snarky Screening[/b]!
 
-[i]You[/i] need to kick off [i]auto-scroll[/i] by scrolling this text up so you can see the whole thing.  You'll also need to re-do it if you [i]resize[/i] the window."""
+[i]You[/i] need to kick off [i]auto-scroll[/i] by scrolling this text up so you can see the whole thing.  You'll also need to re-do it if you [i]resize[/i] the window.""")
+        self.root.ids.snarky_chatstream.text = self.history.text
+
+        # Messages are queued as they arrive and shown at most once a frame,
+        # so a burst costs one relayout and one fade reset instead of many.
+        self.pending = []
+        self.flush_trigger = Clock.create_trigger(self.flush_messages)
+        self.messages_received = 0
+        self.messages_coalesced = 0
+
+        # Timings of messages shown in the last flush, completed when the
+        # frame showing them is drawn
+        self.latency = LatencyStats(self.config.getint('snarky', 'stats_samples'))
+        self.drawing = []
+        Clock.schedule_interval(self.log_stats, self.config.getint('snarky', 'stats_interval'))
+        stats_port = self.config.getint('snarky', 'stats_port')
+        if stats_port:
+            try:
+                reactor.listenTCP(stats_port, server.Site(StatsResource(self)), interface='127.0.0.1')
+            except CannotListenError as e:
+                # The stats are still logged; the screening matters more
+                Logger.warning('Snarky: not serving latency stats: {}'.format(e))
         
         if len(argv) > 1:
             self.root.ids.video.source = argv[1]
         
-        reactor.listenTCP(8000, EchoFactory(self))
+        hub = self.config.get('snarky', 'hub').strip()
+        if hub:
+            host, _, port = hub.rpartition(':')
+            reactor.connectTCP(host or 'localhost', int(port), HubClientFactory(self))
+        else:
+            reactor.listenTCP(8000, EchoFactory(self))
 
-    def handle_message(self, msg):
+    def handle_message(self, msg, timing=None):
         msg = msg.strip(chr(13) + chr(10)) # remove CRLF
         
-        msg = re.sub(r"\*(.*)\*", r"[b]\1[/b]", msg)
-        msg = re.sub(r"_(.*)_",   r"[i]\1[/i]", msg)
+        msg = slack_to_kivy(msg)
         
-        self.root.ids.snarky_chatstream.text += "\n{}".format(msg)
+        self.pending.append((msg, timing))
+        self.flush_trigger()
+        
+        return str(self.root.ids.video.position)
+
+    def flush_messages(self, dt):
+        if not self.pending:
+            return
+        self.messages_received += len(self.pending)
+        self.messages_coalesced += len(self.pending) - 1
+        if len(self.pending) > 1:
+            Logger.debug('Snarky: coalesced {} messages into one frame ({} so far)'.format(
+                len(self.pending), self.messages_coalesced))
+
+        for msg, timing in self.pending:
+            self.history.append(msg)
+            if timing is not None:
+                self.drawing.append(timing)
+        self.pending = []
+        self.root.ids.snarky_chatstream.text = self.history.text
+        if self.drawing:
+            # The new text is laid out and drawn in the next frame, just
+            # before the window flips it onto the screen
+            Window.unbind(on_flip=self.on_flip)
+            Window.bind(on_flip=self.on_flip)
         
         Animation.cancel_all(self.root.ids.snarky_chatwindow)
         self.root.ids.snarky_chatwindow.opacity = 1.0
         anim = Animation(duration=7.0) + Animation(opacity=0.0, duration=3.0)
         anim.start(self.root.ids.snarky_chatwindow)
-        
-        return str(self.root.ids.video.position)
+
+    def on_flip(self, window):
+        window.unbind(on_flip=self.on_flip)
+        drawn = monotonic()
+        for timing in self.drawing:
+            timing['drawn'] = drawn
+            self.latency.add(timing)
+        self.drawing = []
+
+    def stats(self):
+        return collections.OrderedDict([
+            ('messages', self.messages_received),
+            ('coalesced', self.messages_coalesced),
+            ('latency_ms', self.latency.summary()),
+        ])
+
+    def log_stats(self, dt):
+        summary = self.latency.summary()
+        if summary:
+            Logger.info('Snarky: latency p50/p95/p99 ms: {}'.format(', '.join(
+                '{} {p50}/{p95}/{p99}'.format(name, **leg) for name, leg in summary.items())))
+
+    def on_stop(self):
+        Logger.info('Snarky: showed {} messages, {} of them coalesced into an earlier frame'.format(
+            self.messages_received, self.messages_coalesced))
 
     def handle_selection(self, selection, touch):
         self.popup.dismiss()
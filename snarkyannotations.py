@@ -0,0 +1,87 @@
+"""Lazy loading of recorded heckles.
+
+Annotations files are either a JSON array of {"start", "text"[, "duration"]}
+objects, as written by MrHeckles' !heckles export, or JSON Lines with one
+such object per line, as in the heckles.jsonl log it records as it goes.
+Both are read incrementally, so memory use doesn't grow with the length of
+the session.
+"""
+
+import heapq
+import io
+import json
+import re
+
+CHUNK_SIZE = 65536
+
+# How far out of place a quote can be and still come out of in_time_order
+# sorted.  The recorder logs quotes in the order the player showed them, so
+# only a seek during the screening puts them out of order.
+REORDER_WINDOW = 1024
+
+decoder = json.JSONDecoder()
+
+# What comes between the items of an array
+SEPARATORS = re.compile(u'[ \t\r\n,]*')
+
+def iter_json_array(fd):
+    """Yield the items of the JSON array being read from fd, one at a time"""
+    buf = fd.read(CHUNK_SIZE).lstrip()[1:]
+    idx = 0
+    eof = False
+    while True:
+        idx = SEPARATORS.match(buf, idx).end()
+        if buf.startswith(u']', idx):
+            return
+        # Only copy what is left of buf when topping it up, not per item
+        if not eof and len(buf) - idx < CHUNK_SIZE:
+            more = fd.read(CHUNK_SIZE)
+            eof = not more
+            buf = buf[idx:] + more
+            idx = 0
+            continue
+        try:
+            item, idx = decoder.raw_decode(buf, idx)
+        except ValueError:
+            # Most likely the item runs past what has been read so far
+            more = fd.read(CHUNK_SIZE)
+            if not more:
+                raise
+            buf = buf[idx:] + more
+            idx = 0
+            continue
+        yield item
+
+def iter_json_lines(fd):
+    """Yield the objects of the JSON Lines file being read from fd"""
+    for line in fd:
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            continue  # torn final line after a crash
+
+def iter_annotations(path, offset=0):
+    """Yield (index, quote) for each quote in path, skipping the first offset"""
+    with io.open(path, 'r', encoding='utf-8') as fd:
+        array = fd.read(CHUNK_SIZE).lstrip().startswith(u'[')
+        fd.seek(0)
+        quotes = iter_json_array(fd) if array else iter_json_lines(fd)
+        for index, quote in enumerate(quotes):
+            if index >= offset:
+                yield index, quote
+
+def in_time_order(quotes, window=REORDER_WINDOW):
+    """Re-sort a stream of (index, quote) by start time, holding at most
+    window quotes; anything further out of place than that stays out of
+    order"""
+    heap = []
+    for index, quote in quotes:
+        heapq.heappush(heap, (float(quote['start']), index, quote))
+        if len(heap) > window:
+            start, index, quote = heapq.heappop(heap)
+            yield index, quote
+    while heap:
+        start, index, quote = heapq.heappop(heap)
+        yield index, quote
@@ -0,0 +1,77 @@
+"""Checkpoints for long screenshot runs.
+
+A manifest maps each quote's index and start time to the screenshot made
+for it, with the file's size and SHA-1.  It is rewritten atomically after
+every capture, so a run that crashes or is closed halfway can be started
+again and only renders the quotes whose screenshots are missing, truncated
+or changed.
+"""
+
+import hashlib
+import json
+import os
+import os.path
+
+MANIFEST = 'screenshots.manifest.json'
+
+def file_digest(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as fd:
+        for block in iter(lambda: fd.read(65536), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+class Checkpoint(object):
+    """Manifest of finished screenshots, keyed by quote index.  Paths are
+    stored relative to the manifest, so a run can be resumed from any
+    working directory."""
+
+    def __init__(self, path):
+        self.path = path
+        self.root = os.path.dirname(os.path.abspath(path))
+        self.entries = {}
+        self.skipped = 0
+        if os.path.exists(path):
+            try:
+                with open(path, 'r') as fd:
+                    self.entries = json.load(fd)
+            except ValueError:
+                pass  # unreadable manifest; everything gets rendered again
+
+    def done(self, index, start):
+        """True if index has a screenshot at start that is still intact"""
+        entry = self.entries.get(str(index))
+        if entry is None or entry['start'] != float(start):
+            return False
+        path = os.path.join(self.root, entry['path'])
+        try:
+            if os.path.getsize(path) != entry['size']:
+                return False
+        except OSError:
+            return False
+        return file_digest(path) == entry['sha1']
+
+    def pending(self, quotes):
+        """Filter a stream of (index, quote) down to the ones still to do"""
+        for index, quote in quotes:
+            if self.done(index, quote['start']):
+                self.skipped += 1
+            else:
+                yield index, quote
+
+    def add(self, index, start, path):
+        """Record path as the screenshot for index; save() writes it out"""
+        self.entries[str(index)] = {
+            'start': float(start),
+            'path': os.path.relpath(os.path.abspath(path), self.root),
+            'size': os.path.getsize(path),
+            'sha1': file_digest(path),
+        }
+
+    def save(self):
+        tmppath = self.path + '.tmp'
+        with open(tmppath, 'w') as out:
+            json.dump(self.entries, out, indent=1, sort_keys=True)
+            out.flush()
+            os.fsync(out.fileno())
+        os.rename(tmppath, self.path)
@@ -0,0 +1,157 @@
+"""Headless version of snarkyscreenshots.py.
+
+Renders one captioned still per quote without opening a window: ffmpeg
+decodes the exact frame at each quote's start time and burns in the caption
+as an ASS subtitle, outlined to match the player, straight into a PNG.
+
+Quotes are read lazily, put in time order and grouped by the keyframe
+interval (GOP) they fall in.  Each group is one ffmpeg pass that seeks to the keyframe once and
+decodes forward, writing every quote's frame on the way, instead of paying a
+full seek and keyframe re-decode per quote.  Groups are spread across a pool
+of worker processes, so throughput scales with cores.
+
+Finished screenshots are recorded in a manifest in OUTDIR (see
+snarkycheckpoint.py), and a rerun only renders the ones that are missing or
+don't match it.
+
+    python snarkyheadless.py movie.mp4 heckles.json [-j WORKERS] [-o OUTDIR] [--offset N]
+
+Needs ffmpeg (built with libass) and ffprobe on the PATH.
+"""
+
+import argparse
+import bisect
+import itertools
+import multiprocessing
+import os
+import os.path
+import subprocess
+import tempfile
+
+from snarkysubtitles import probe, filter_escape, ass_header, ass_event
+from snarkyannotations import iter_annotations, in_time_order
+from snarkycheckpoint import Checkpoint, MANIFEST
+
+# Most quotes rendered in one ffmpeg pass; each is a separate output with its
+# own filter graph, so very busy GOPs are split up.
+MAX_GROUP_SIZE = 32
+
+def keyframes(video):
+    """Return the sorted timestamps of the video stream's keyframes"""
+    output = subprocess.check_output([
+        'ffprobe', '-v', 'error', '-select_streams', 'v:0',
+        '-show_entries', 'packet=pts_time,flags', '-of', 'csv=print_section=0', video])
+    times = []
+    for line in output.splitlines():
+        pts_time, _, flags = line.partition(',')
+        if 'K' in flags and pts_time not in ('', 'N/A'):
+            times.append(float(pts_time))
+    times.sort()
+    return times or [0.0]
+
+def group_quotes(quotes, keyframe_times):
+    """Group time-ordered (index, quote) pairs by preceding keyframe,
+    yielding (keyframe time, [(index, quote), ...]) with at most
+    MAX_GROUP_SIZE quotes per group"""
+    def keyframe(item):
+        position = bisect.bisect_right(keyframe_times, float(item[1]['start'])) - 1
+        return keyframe_times[position] if position >= 0 else 0.0
+    for key, group in itertools.groupby(quotes, keyframe):
+        group = list(group)
+        for offset in range(0, len(group), MAX_GROUP_SIZE):
+            yield key, group[offset:offset + MAX_GROUP_SIZE]
+
+def write_caption(text, start, size, font):
+    """Write a temporary ASS file showing the caption from start on"""
+    fd, path = tempfile.mkstemp(suffix='.ass', prefix='snarky')
+    with os.fdopen(fd, 'w') as out:
+        out.write((ass_header(size, font) + ass_event(start, 36000, text)).encode('utf-8'))
+    return path
+
+def output_path(outdir, index):
+    return os.path.join(outdir, 'screenshot{:04d}.png'.format(index + 1))
+
+def render_group(job):
+    """Worker: render one group of quotes in a single decode pass, returning
+    [(index, start, output path), ...], the seconds from the keyframe to the
+    last quote, and the sum of the seconds from the keyframe to each quote.
+    They estimate the video decoded in this pass and by seeking to each
+    quote separately; ffmpeg doesn't report either."""
+    video, keyframe, group, outdir, size, font = job
+    # -ss before -i lands on the keyframe, so timestamps restart from zero
+    # there.  Every quote is then its own output, which drops frames until
+    # its offset and keeps just the next one; ffmpeg decodes the shared input
+    # once for all of them.
+    command = ['ffmpeg', '-v', 'error', '-y', '-ss', repr(keyframe), '-i', video]
+    subtitles = []
+    results = []
+    try:
+        for index, quote in group:
+            offset = max(float(quote['start']) - keyframe, 0.0)
+            # Start the caption a little early so rounding to ASS's
+            # centiseconds can never leave the chosen frame without it
+            subtitles.append(write_caption(quote['text'], max(offset - 0.5, 0), size, font))
+            path = output_path(outdir, index)
+            command += ['-vf', 'ass=' + filter_escape(subtitles[-1]),
+                        '-ss', repr(offset), '-frames:v', '1', path]
+            results.append((index, quote['start'], path))
+        subprocess.check_call(command)
+    finally:
+        for path in subtitles:
+            os.remove(path)
+    offsets = [float(quote['start']) - keyframe for index, quote in group]
+    return results, max(offsets), sum(offsets)
+
+def main():
+    parser = argparse.ArgumentParser(description='Render captioned screenshots without a window.')
+    parser.add_argument('video')
+    parser.add_argument('quotes')
+    parser.add_argument('-j', '--workers', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('-o', '--outdir', default='.')
+    parser.add_argument('--font', default='Sans', help='font name for the captions, e.g. "Lucida Fax"')
+    parser.add_argument('--offset', type=int, default=0, help='skip this many quotes')
+    args = parser.parse_args()
+
+    size, fps = probe(args.video)
+    keyframe_times = keyframes(args.video)
+    if not os.path.isdir(args.outdir):
+        os.makedirs(args.outdir)
+
+    checkpoint = Checkpoint(os.path.join(args.outdir, MANIFEST))
+    quotes = checkpoint.pending(in_time_order(iter_annotations(args.quotes, args.offset)))
+    jobs = ((args.video, keyframe, group, args.outdir, size, args.font)
+            for keyframe, group in group_quotes(quotes, keyframe_times))
+    screenshots = passes = 0
+    decoded = ungrouped = 0.0
+    pool = multiprocessing.Pool(args.workers)
+    try:
+        # Pool.imap would read every job up front, so hand them over a few
+        # at a time to keep memory flat on long sessions.
+        while True:
+            batch = list(itertools.islice(jobs, args.workers * 4))
+            if not batch:
+                break
+            for results, seconds, separately in pool.imap_unordered(render_group, batch):
+                passes += 1
+                screenshots += len(results)
+                decoded += seconds
+                ungrouped += separately
+                for index, start, path in results:
+                    checkpoint.add(index, start, path)
+                    print '{} {} {}'.format(index, start, path)
+                checkpoint.save()
+    finally:
+        pool.close()
+        pool.join()
+
+    if checkpoint.skipped:
+        print 'Skipped {} screenshots already in {}'.format(checkpoint.skipped, checkpoint.path)
+    if screenshots:
+        # Worked out from the quotes' distances from their keyframes and the
+        # frame rate, not counted, so both are estimates
+        print 'Estimated {:.0f} frames decoded for {} screenshots: about {:.1f} per screenshot, against {:.1f} if seeking each one'.format(
+            decoded * fps + passes, screenshots,
+            (decoded * fps + passes) / screenshots, (ungrouped * fps + screenshots) / screenshots)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+"""Broadcast hub: one heckle feed shown on several players at once.
+
+MrHeckles connects to the hub's ingest port exactly as it would to a
+player.  Players started with a hub setting (see main.py) connect to the
+subscriber port instead of listening themselves, and every message sent to
+the ingest port is passed on to all of them over the same framed protocol.
+
+Each subscriber has its own bounded queue and at most a few unacknowledged
+messages in flight.  When a display falls behind, the oldest messages in
+its queue are dropped; nothing it does can hold up the feed or the other
+displays.  The ingest side is answered straight away with the last video
+position reported by the primary subscriber, the one connected longest.
+
+    python snarkyhub.py [--ingest-port 8000] [--subscriber-port 8001]
+    python snarkyhub.py --swarm 50 [--slow 5] [--messages 2000]
+
+--swarm load-tests the hub in-process: it starts that many fake players,
+some of which acknowledge slowly, floods the ingest port, and reports what
+each kind of player received.
+
+Needs Twisted, but not Kivy.
+"""
+
+import argparse
+import collections
+import json
+import sys
+import time
+
+from twisted.internet import reactor, protocol, task
+from twisted.protocols.basic import Int32StringReceiver
+from twisted.python import log
+
+INGEST_PORT = 8000
+SUBSCRIBER_PORT = 8001
+QUEUE_SIZE = 100      # messages held for a subscriber that is behind
+WINDOW = 8            # unacknowledged messages in flight per subscriber
+STATS_INTERVAL = 60   # seconds between status lines in the log
+
+class Hub(object):
+    def __init__(self, queue_size=QUEUE_SIZE, window=WINDOW):
+        self.queue_size = queue_size
+        self.window = window
+        self.subscribers = []
+        self.position = ''
+        self.published = 0
+
+    @property
+    def primary(self):
+        return self.subscribers[0] if self.subscribers else None
+
+    def subscribe(self, subscriber):
+        self.subscribers.append(subscriber)
+        log.msg('Subscriber {} connected, {} in all'.format(subscriber.name, len(self.subscribers)))
+
+    def unsubscribe(self, subscriber):
+        if subscriber in self.subscribers:
+            self.subscribers.remove(subscriber)
+        log.msg('Subscriber {} gone after {} messages, {} dropped; {} left'.format(
+            subscriber.name, subscriber.sent, subscriber.dropped, len(self.subscribers)))
+
+    def publish(self, frame):
+        self.published += 1
+        for subscriber in self.subscribers:
+            subscriber.enqueue(frame)
+
+    def acked(self, subscriber, position):
+        if subscriber is self.primary and position:
+            self.position = position
+
+    def log_stats(self):
+        log.msg('{} messages published; {}'.format(self.published, ', '.join(
+            '{}: {} queued, {} dropped'.format(subscriber.name, len(subscriber.queue), subscriber.dropped)
+            for subscriber in self.subscribers) or 'no subscribers'))
+
+class SubscriberProtocol(Int32StringReceiver):
+    """A player fed by the hub.  Every frame sent is answered with a video
+    position, which frees a slot in the window for the next one."""
+
+    def connectionMade(self):
+        hub = self.factory.hub
+        peer = self.transport.getPeer()
+        self.name = '{}:{}'.format(peer.host, peer.port)
+        self.queue = collections.deque(maxlen=hub.queue_size)
+        self.inflight = 0
+        self.sent = 0
+        self.dropped = 0
+        hub.subscribe(self)
+
+    def connectionLost(self, reason):
+        self.factory.hub.unsubscribe(self)
+
+    def enqueue(self, frame):
+        if len(self.queue) == self.queue.maxlen:
+            self.dropped += 1  # the deque drops the oldest to make room
+        self.queue.append(frame)
+        self.pump()
+
+    def pump(self):
+        while self.queue and self.inflight < self.factory.hub.window:
+            self.sendString(self.queue.popleft())
+            self.inflight += 1
+            self.sent += 1
+
+    def stringReceived(self, data):
+        self.inflight = max(self.inflight - 1, 0)
+        self.factory.hub.acked(self, data)
+        self.pump()
+
+class SubscriberFactory(protocol.Factory):
+    protocol = SubscriberProtocol
+
+    def __init__(self, hub):
+        self.hub = hub
+
+class IngestProtocol(Int32StringReceiver):
+    """The bot's side: the same protocol as a player, but every message is
+    answered at once, without waiting on any display."""
+
+    def stringReceived(self, data):
+        self.factory.hub.publish(data)
+        self.sendString(self.factory.hub.position)
+
+class IngestFactory(protocol.Factory):
+    protocol = IngestProtocol
+
+    def __init__(self, hub):
+        self.hub = hub
+
+class FakePlayer(Int32StringReceiver):
+    """Swarm subscriber: counts messages and acknowledges each one after
+    the factory's delay, reporting the time as its video position."""
+
+    def connectionMade(self):
+        self.received = 0
+        self.factory.players.append(self)
+
+    def stringReceived(self, data):
+        self.received += 1
+        if self.factory.delay:
+            reactor.callLater(self.factory.delay, self.ack)
+        else:
+            self.ack()
+
+    def ack(self):
+        if self.transport.connected:
+            self.sendString(repr(time.time()))
+
+class FakePlayerFactory(protocol.ClientFactory):
+    protocol = FakePlayer
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.players = []
+
+class FakeBot(Int32StringReceiver):
+    """Swarm ingest: sends messages at a steady rate and counts the acks"""
+
+    def connectionMade(self):
+        self.acks = 0
+        self.sent = 0
+        self.started = time.time()
+        self.sender = task.LoopingCall(self.send_batch)
+        self.sender.start(0.01)
+
+    def send_batch(self):
+        factory = self.factory
+        due = min(factory.messages, int((time.time() - self.started) * factory.rate) + 1)
+        while self.sent < due:
+            self.sendString(json.dumps({'text': u'<swarm> heckle {}'.format(self.sent)}))
+            self.sent += 1
+        if self.sent == factory.messages:
+            self.sender.stop()
+
+    def stringReceived(self, data):
+        self.acks += 1
+        if self.acks == self.factory.messages:
+            self.factory.finished = time.time() - self.started
+            # Give the players a moment to drain before counting
+            reactor.callLater(self.factory.settle, reactor.stop)
+
+class FakeBotFactory(protocol.ClientFactory):
+    protocol = FakeBot
+
+    def __init__(self, messages, rate, settle):
+        self.messages = messages
+        self.rate = rate
+        self.settle = settle
+        self.finished = None
+
+def swarm(args, hub):
+    fast = FakePlayerFactory(0)
+    slow = FakePlayerFactory(args.slow_delay)
+    for count in range(args.swarm):
+        factory = slow if count < args.slow else fast
+        reactor.connectTCP('localhost', args.subscriber_port, factory)
+    bot = FakeBotFactory(args.messages, args.rate, settle=2.0)
+    # Let the players connect before the feed starts
+    reactor.callLater(1.0, reactor.connectTCP, 'localhost', args.ingest_port, bot)
+    # The hub forgets subscribers as the connections close on shutdown
+    dropped = []
+    reactor.addSystemEventTrigger('before', 'shutdown', lambda: dropped.extend(
+        subscriber.dropped for subscriber in hub.subscribers))
+    reactor.run()
+
+    print 'Ingest: {} messages acknowledged in {:.2f}s'.format(
+        args.messages, bot.finished or float('nan'))
+    for name, factory in (('fast', fast), ('slow', slow)):
+        if factory.players:
+            counts = [player.received for player in factory.players]
+            print '{} players x{}: received min {}, mean {:.0f}, max {}'.format(
+                name, len(counts), min(counts), float(sum(counts)) / len(counts), max(counts))
+    print 'Hub dropped {} messages across {} subscribers'.format(sum(dropped), len(dropped))
+
+def main():
+    parser = argparse.ArgumentParser(description='Broadcast one heckle feed to several players.')
+    parser.add_argument('--ingest-port', type=int, default=INGEST_PORT)
+    parser.add_argument('--subscriber-port', type=int, default=SUBSCRIBER_PORT)
+    parser.add_argument('--queue-size', type=int, default=QUEUE_SIZE)
+    parser.add_argument('--window', type=int, default=WINDOW)
+    parser.add_argument('--swarm', type=int, metavar='N', help='load-test with N fake players')
+    parser.add_argument('--slow', type=int, default=0, help='how many of the swarm acknowledge slowly')
+    parser.add_argument('--slow-delay', type=float, default=0.5, help='seconds a slow player takes per message')
+    parser.add_argument('--messages', type=int, default=1000, help='messages to send in the swarm test')
+    parser.add_argument('--rate', type=float, default=500, help='messages per second in the swarm test')
+    args = parser.parse_args()
+
+    hub = Hub(args.queue_size, args.window)
+    reactor.listenTCP(args.ingest_port, IngestFactory(hub))
+    reactor.listenTCP(args.subscriber_port, SubscriberFactory(hub))
+    if args.swarm:
+        swarm(args, hub)
+    else:
+        log.startLogging(sys.stdout)
+        task.LoopingCall(hub.log_stats).start(STATS_INTERVAL, now=False)
+        reactor.run()
+
+if __name__ == '__main__':
+    main()
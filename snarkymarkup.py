@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""Slack message formatting to Kivy markup, subtitle formats or plain text.
+
+Slack sends *bold*, _italic_, ~strike~ and `code` spans, and escapes &, <
+and > as entities.  Kivy markup uses [b]-style tags, so any literal [ or ]
+in a message has to be escaped too, or a heckle like "[size=500]" would be
+taken as markup.  Everything is done in one pass of a precompiled pattern.
+
+Run this file with an annotations file (a JSON array or JSON Lines of
+{"start": ..., "text": ...}) to time it against the old pair of re.sub calls:
+
+    python snarkymarkup.py heckles.json
+"""
+
+import re
+
+MARKUP_PATTERN = re.compile(u"""
+    (?P<entity>&(?:amp|lt|gt);|[&<>\\[\\]{}\\\\\\n])
+  | (?<![\\w*_~`])
+    (?P<mark>[*_~`])
+    (?P<body>\\S(?:[^\\n]*?\\S)??)
+    (?P=mark)
+    (?![\\w*_~`])
+""", re.UNICODE | re.VERBOSE)
+
+ENTITY_PATTERN = re.compile(u"&(?:amp|lt|gt);|[&<>\\[\\]{}\\\\\\n]")
+
+SLACK_ENTITIES = {
+    u'&amp;': u'&',
+    u'&lt;': u'<',
+    u'&gt;': u'>',
+}
+
+class Translator(object):
+    """Translates Slack formatting using one set of span tags, plus
+    replacements for Slack's entities and the target's special characters;
+    anything without a replacement is kept as-is."""
+
+    def __init__(self, tags, entities):
+        self.tags = tags
+        self.entities = entities
+
+    def replace_entity(self, match):
+        return self.entities.get(match.group(), match.group())
+
+    def escape(self, text):
+        """Escape text so the target shows it literally"""
+        return ENTITY_PATTERN.sub(self.replace_entity, text)
+
+    def replace(self, match):
+        entity = match.group('entity')
+        if entity is not None:
+            return self.entities.get(entity, entity)
+        opening, closing = self.tags[match.group('mark')]
+        if match.group('mark') == u'`':
+            # No formatting inside code spans
+            return opening + self.escape(match.group('body')) + closing
+        return opening + self.translate(match.group('body')) + closing
+
+    def translate(self, text):
+        return MARKUP_PATTERN.sub(self.replace, text)
+
+KIVY = Translator(
+    tags={
+        u'*': (u'[b]', u'[/b]'),
+        u'_': (u'[i]', u'[/i]'),
+        u'~': (u'[s]', u'[/s]'),
+        u'`': (u'[font=RobotoMono-Regular]', u'[/font]'),
+    },
+    entities={
+        u'&amp;': u'&amp;',
+        u'&lt;': u'<',
+        u'&gt;': u'>',
+        u'&': u'&amp;',
+        u'[': u'&bl;',
+        u']': u'&br;',
+    })
+
+ASS = Translator(
+    tags={
+        u'*': (u'{\\b1}', u'{\\b0}'),
+        u'_': (u'{\\i1}', u'{\\i0}'),
+        u'~': (u'{\\s1}', u'{\\s0}'),
+        u'`': (u'{\\fnMonospace}', u'{\\fn}'),
+    },
+    entities=dict(SLACK_ENTITIES, **{
+        u'{': u'\\{',
+        u'}': u'\\}',
+        # A word joiner stops "\n", "\N" and "\h" being read as escapes
+        u'\\': u'\\\u2060',
+        u'\n': u'\\N',
+    }))
+
+# WebVTT cue text: HTML-like tags and entities, no strikethrough
+VTT = Translator(
+    tags={
+        u'*': (u'<b>', u'</b>'),
+        u'_': (u'<i>', u'</i>'),
+        u'~': (u'', u''),
+        u'`': (u'', u''),
+    },
+    entities={
+        u'&': u'&amp;',
+        u'<': u'&lt;',
+        u'>': u'&gt;',
+    })
+
+PLAIN = Translator(
+    tags=dict((mark, (u'', u'')) for mark in u'*_~`'),
+    entities=SLACK_ENTITIES)
+
+def slack_to_kivy(text):
+    """Translate a Slack-formatted message into Kivy markup"""
+    return KIVY.translate(text)
+
+def slack_to_ass(text):
+    """Translate a Slack-formatted message into ASS subtitle text"""
+    return ASS.translate(text)
+
+def slack_to_vtt(text):
+    """Translate a Slack-formatted message into WebVTT cue text"""
+    return VTT.translate(text)
+
+def slack_to_plain(text):
+    """Strip Slack formatting from a message, for renderers without markup"""
+    return PLAIN.translate(text)
+
+if __name__ == '__main__':
+    import sys, timeit
+    from snarkyannotations import iter_annotations
+
+    lines = [quote['text'] for index, quote in iter_annotations(sys.argv[1])]
+
+    def old():
+        for line in lines:
+            line = re.sub(r"\*(.*)\*", r"[b]\1[/b]", line)
+            line = re.sub(r"_(.*)_",   r"[i]\1[/i]", line)
+
+    def new():
+        for line in lines:
+            slack_to_kivy(line)
+
+    for name, func in (('re.sub x2', old), ('slack_to_kivy', new)):
+        best = min(timeit.repeat(func, number=10, repeat=5)) / 10
+        print '{:>14}: {:.2f} us/line over {} lines'.format(name, best / len(lines) * 1e6, len(lines))
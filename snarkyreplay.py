@@ -0,0 +1,245 @@
+"""Replay a recorded session against the player, to load-test a screening.
+
+Reads an annotations file (a JSON array export or the heckles.jsonl log)
+and sends its heckles at their original pace, N times faster, or as fast
+as possible, either straight to the player's port or through MrHeckles
+itself, fed fake Slack messages so its queue, rate limits and formatting
+are all exercised.  At the end it reports how many heckles the player
+acknowledged, how many answers were garbled (not a video position) or
+never came, and percentiles of the time from sending to acknowledgement.
+
+    python snarkyreplay.py heckles.jsonl [--speed 10 | --fast] [--port 8000]
+    python snarkyreplay.py heckles.jsonl --plugin [--no-limits] [--speed 10]
+
+The player answers each message as soon as its event loop reads it, before
+the frame that shows it is drawn, so latencies rise sharply once the
+overlay can't keep up; that knee is the throughput ceiling.  --plugin needs
+errbot and unidecode installed.
+"""
+
+import argparse
+import collections
+import json
+import os
+import os.path
+import re
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+from snarkyannotations import iter_annotations, in_time_order
+
+DRAIN_TIMEOUT = 10.0  # seconds to wait for the last acknowledgements
+REPLAY_CHANNEL = 'snarkyreplay'
+
+# The wire protocol: 4-byte big-endian length, then the payload
+frame_header = struct.Struct('!I')
+
+def schedule(path, speed):
+    """Yield (delay from the start, text), with delays divided by speed, or
+    all zero when speed is 0"""
+    first = None
+    for index, quote in in_time_order(iter_annotations(path)):
+        start = float(quote['start'])
+        if first is None:
+            first = start
+        yield ((start - first) / speed if speed else 0.0), quote['text']
+
+def pace(messages, send):
+    """Call send(text) for each message at its time"""
+    began = time.time()
+    for delay, text in messages:
+        wait = began + delay - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        send(text)
+
+def is_position(answer):
+    try:
+        float(answer)
+    except ValueError:
+        return False
+    return True
+
+class Results(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.acked = 0
+        self.garbled = 0
+        self.latencies = []
+        self.began = time.time()
+        self.finished = None
+
+    def ack(self, answer, latency):
+        with self.lock:
+            self.acked += 1
+            if latency is not None:
+                self.latencies.append(latency)
+            if not is_position(answer):
+                self.garbled += 1
+            self.finished = time.time()
+
+    def wait(self, done=None, timeout=DRAIN_TIMEOUT):
+        """Wait until everything sent is acknowledged, or done() is true"""
+        done = done or (lambda: self.acked >= self.sent)
+        deadline = time.time() + timeout
+        while not done() and time.time() < deadline:
+            time.sleep(0.05)
+
+    def report(self, dropped=None):
+        latencies = sorted(self.latencies)
+        elapsed = (self.finished or time.time()) - self.began
+        print 'Sent {}, acknowledged {}, garbled {}, dropped {}'.format(
+            self.sent, self.acked, self.garbled,
+            self.sent - self.acked if dropped is None else dropped)
+        if elapsed > 0:
+            print 'Throughput: {:.1f} heckles/s over {:.1f}s'.format(self.acked / elapsed, elapsed)
+        if latencies:
+            def percentile(fraction):
+                return latencies[min(int(len(latencies) * fraction), len(latencies) - 1)] * 1000
+            print 'Latency: median {:.1f} ms, 90% {:.1f} ms, 99% {:.1f} ms, max {:.1f} ms'.format(
+                percentile(0.5), percentile(0.9), percentile(0.99), latencies[-1] * 1000)
+
+def replay_tcp(args, messages):
+    """Send straight to the player, one frame per heckle"""
+    sock = socket.create_connection((args.host, args.port))
+    results = Results()
+    sent_at = collections.deque()
+    lock = threading.Lock()
+
+    def read():
+        buf = ''
+        while True:
+            try:
+                data = sock.recv(65536)
+            except socket.error:
+                return
+            if not data:
+                return
+            buf += data
+            while len(buf) >= frame_header.size:
+                (length,) = frame_header.unpack_from(buf)
+                if len(buf) < frame_header.size + length:
+                    break
+                answer = buf[frame_header.size:frame_header.size + length]
+                buf = buf[frame_header.size + length:]
+                with lock:
+                    since = sent_at.popleft() if sent_at else None
+                results.ack(answer, time.time() - since if since is not None else None)
+
+    reader = threading.Thread(target=read, name='SnarkyReplayReader')
+    reader.daemon = True
+    reader.start()
+
+    def send(text):
+        payload = json.dumps({'text': text})
+        with lock:
+            sent_at.append(time.time())
+        sock.sendall(frame_header.pack(len(payload)) + payload)
+        results.sent += 1
+
+    pace(messages, send)
+    results.wait()
+    sock.close()
+    results.report()
+
+class FakeOccupant(object):
+    """Just enough of a SlackMUCOccupant for MrHeckles.callback_message"""
+    def __init__(self, fullname):
+        self.channelid = REPLAY_CHANNEL
+        self.channelname = REPLAY_CHANNEL
+        self.fullname = fullname
+
+class FakeMessage(object):
+    """Just enough of an Errbot Message for MrHeckles.callback_message"""
+    type = 'groupchat'
+
+    def __init__(self, text):
+        # The log holds "<name> text" as the player showed it; send it the
+        # way a Sameroom relay would, with the name in the body
+        self.body = re.sub(u'^<([^>]*)>', u'&lt;\\1&gt;', text)
+        self.frm = FakeOccupant(u'<None>')
+        self.extras = {}
+
+def replay_plugin(args, messages):
+    """Send through MrHeckles, as if the heckles were said in Slack"""
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'MrHeckles'))
+    import mrheckles
+
+    fd, record = tempfile.mkstemp(suffix='.jsonl', prefix='snarkyreplay')
+    os.close(fd)
+    config = dict(mrheckles.default_config, CHANNELS={
+        REPLAY_CHANNEL: {'host': args.host, 'port': args.port, 'record': record}})
+    if args.no_limits:
+        for key in ('USER', 'CHANNEL', 'GLOBAL'):
+            config[key + '_RATE'] = config[key + '_BURST'] = 1e9
+
+    plugin = mrheckles.MrHeckles(None)
+    plugin.start_relays(config)
+    plugin.routes = {REPLAY_CHANNEL: plugin.channels[REPLAY_CHANNEL]}
+    route = plugin.routes[REPLAY_CHANNEL]
+
+    # The relay times each heckle from queueing to acknowledgement itself
+    results = Results()
+    def on_ack(text, position):
+        if not text.startswith('<Mr. Heckles>'):
+            results.ack(position, None)
+        route.recorder.record(text, position)
+    route.relay.on_ack = on_ack
+
+    # Stand-in for Errbot's poller, releasing heckles held by the limits
+    running = [True]
+    def poll():
+        while running[0]:
+            plugin.release_held()
+            time.sleep(mrheckles.flush_interval)
+    poller = threading.Thread(target=poll, name='SnarkyReplayPoller')
+    poller.daemon = True
+    poller.start()
+
+    def send(text):
+        plugin.callback_message(FakeMessage(text))
+        results.sent += 1
+
+    try:
+        pace(messages, send)
+        # Held lines are merged, so fewer acknowledgements than heckles
+        # are expected while the limits are on
+        def drained():
+            stats = route.relay.stats()
+            return not (plugin.limiter.held or stats['depth'] or stats['inflight'])
+        time.sleep(mrheckles.flush_interval)
+        results.wait(drained)
+        results.latencies = route.relay.stats()['latencies']
+    finally:
+        running[0] = False
+        plugin.stop_relays()
+        os.remove(record)
+    stats = route.relay.stats()
+    results.report(dropped=stats['dropped'])
+    print 'Rate limits: {} lines passed, {} heckles merged into them'.format(
+        plugin.limiter.passed, plugin.limiter.merged)
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a recorded session against the player.')
+    parser.add_argument('quotes', help='annotations file, a JSON array or JSON Lines')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--speed', type=float, default=1.0, help='replay this many times faster than recorded')
+    parser.add_argument('--fast', action='store_true', help='send everything as fast as possible')
+    parser.add_argument('--plugin', action='store_true', help='go through MrHeckles instead of straight to the player')
+    parser.add_argument('--no-limits', action='store_true', help="with --plugin, turn off MrHeckles' rate limits")
+    args = parser.parse_args()
+
+    messages = schedule(args.quotes, 0 if args.fast else args.speed)
+    if args.plugin:
+        replay_plugin(args, messages)
+    else:
+        replay_tcp(args, messages)
+
+if __name__ == '__main__':
+    main()
@@ -11,15 +11,27 @@ from kivy.clock import Clock
 
 from sys import argv
 import os.path
-import json
 import time
 
+from snarkymarkup import slack_to_kivy
+from snarkyannotations import iter_annotations, in_time_order
+from snarkycheckpoint import Checkpoint, MANIFEST
+
 Config.set('graphics', 'width', 800)
 Config.set('graphics','height', 400)
 
 kivy.require('1.9.0')
 # Logger.setLevel('DEBUG')
 
+SEEK_TOLERANCE = 0.04  # seconds; about a frame, the most a capture may lead its quote
+SEEK_TIMEOUT = 10      # seconds to wait for a seek before capturing anyway
+# Seconds ahead a quote can be and still be reached by letting the video
+# play on instead of seeking.  A seek re-decodes from the keyframe before
+# the target, so quotes close together would each pay for the same
+# keyframe; but playback only runs in real time, so far-off quotes are
+# still quicker to seek to.
+PLAY_THROUGH = 1.0
+
 UseLucidaFax = False
 if os.path.exists(os.path.join(os.path.expanduser('~'), 'Library/Fonts/Monotype  - Lucida Fax.otf')):
     KIVY_FONTS = [
@@ -63,34 +75,82 @@ class SnarkyScreenshotsApp(App):
         
         self.root.remove_widget(self.root.ids.bottom_layout)
         
+        self.quotes = iter(())
+        self.captured = False  # until then, the position isn't the quote's
+        # Screenshots already in the manifest, and still intact, are skipped
+        self.checkpoint = Checkpoint(MANIFEST)
         if len(argv) > 2:
             self.root.ids.video.source = argv[1]
             if os.path.exists(argv[2]):
-                with open(argv[2], 'r') as fd:
-                    self.quotes = json.load(fd)
-
-            Clock.schedule_once(self.on_loaded, 5)
-
-    def on_loaded(self, dt):
-        if self.root.ids.video.duration != -1:
-            if self.quotes:
-                quote = self.quotes.pop(0)
-                print quote
-                self.root.ids.snarky_chatstream.text = "{}".format(quote['text'])
-                self.root.ids.video.seek(float(quote['start']) / self.root.ids.video.duration)
-                Clock.schedule_once(self.on_seeked, -1)
-        else:
-            Clock.schedule_once(self.on_loaded, 5)
-
-    def on_seeked(self, dt):
+                # Read lazily, in time order so seeks go forwards; an
+                # optional third argument skips that many quotes.
+                offset = int(argv[3]) if len(argv) > 3 else 0
+                self.quotes = self.checkpoint.pending(
+                    in_time_order(iter_annotations(argv[2], offset)))
+
+            self.root.ids.video.bind(duration=self.on_duration)
+
+    def on_duration(self, video, duration):
+        # The duration is only known once the video has loaded
+        if duration > 0:
+            video.unbind(duration=self.on_duration)
+            self.next_quote()
+
+    def next_quote(self):
+        index, quote = next(self.quotes, (None, None))
+        if quote is not None:
+            print index, quote
+            self.index = index
+            self.target = float(quote['start'])
+            self.root.ids.snarky_chatstream.text = slack_to_kivy(quote['text'])
+            video = self.root.ids.video
+            self.seek_from = video.position
+            video.state = 'play'
+            video.bind(position=self.on_position)
+            self.timeout = Clock.schedule_once(self.on_timeout, SEEK_TIMEOUT)
+            if self.captured and 0 <= self.target - video.position <= PLAY_THROUGH:
+                return
+            video.seek(self.target / video.duration)
+
+    def on_position(self, video, position):
+        # Seeks land on a keyframe and playback carries on from there, so
+        # wait until the video has played up to the quote.  Quotes are
+        # nearly always in time order; when one isn't, positions from before
+        # the backwards seek have to be ignored.
+        if self.target < self.seek_from and position >= self.seek_from:
+            return
+        if position >= self.target - SEEK_TOLERANCE:
+            self.on_seeked()
+
+    def on_timeout(self, dt):
+        Logger.warning('Snarky: seek to {} timed out at {}, capturing anyway'.format(
+            self.target, self.root.ids.video.position))
+        self.on_seeked()
+
+    def on_seeked(self):
+        self.root.ids.video.unbind(position=self.on_position)
+        self.timeout.cancel()
         self.root.ids.video.state = 'pause'
-        Clock.schedule_once(self.on_paused, 1)
+        # The new frame is on the video's texture now; capture it once it
+        # has been drawn, just before the window flips it onto the screen.
+        Window.bind(on_flip=self.on_flip)
 
-    def on_paused(self, dt):
+    def on_flip(self, window):
+        window.unbind(on_flip=self.on_flip)
         print str(self.root.ids.video.position)
-        Window.screenshot()
-        self.root.ids.video.state = 'play'
-        Clock.schedule_once(self.on_loaded, 1)
+        # Name the file after the quote, like snarkyheadless.py, so a rerun
+        # replaces a bad screenshot instead of adding another
+        path = 'screenshot{:04d}.png'.format(self.index + 1)
+        os.rename(window.screenshot(), path)
+        self.checkpoint.add(self.index, self.target, path)
+        self.checkpoint.save()
+        self.captured = True
+        Clock.schedule_once(lambda dt: self.next_quote(), 0)
+
+    def on_stop(self):
+        if self.checkpoint.skipped:
+            Logger.info('Snarky: skipped {} screenshots already in {}'.format(
+                self.checkpoint.skipped, MANIFEST))
 
 if __name__ == '__main__':
     SnarkyScreenshotsApp().run()
@@ -0,0 +1,161 @@
+"""Export recorded heckles as a subtitle track.
+
+Turns an annotations file into SRT, WebVTT or ASS, the last styled with the
+player's outlined captions, and can burn the track into a copy of the film
+in one linear ffmpeg pass instead of rendering thousands of screenshots.
+
+    python snarkysubtitles.py heckles.json heckles.ass [--video movie.mp4]
+    python snarkysubtitles.py heckles.json heckles.ass --video movie.mp4 --burn heckled.mp4
+
+The format is taken from the output's extension (.srt, .vtt or .ass).  ASS
+is scaled to the video's size when --video is given.  Burning in needs
+ffmpeg (built with libass and libx264) and ffprobe on the PATH.
+"""
+
+import argparse
+import codecs
+import json
+import os
+import subprocess
+import tempfile
+
+from snarkymarkup import slack_to_ass, slack_to_vtt, slack_to_plain
+from snarkyannotations import iter_annotations, in_time_order
+
+# The player lays a 36sp caption with a 4dp outline over an 800x400 window;
+# scale both from that window height to the height of the video.
+PLAYER_WIDTH = 800
+PLAYER_HEIGHT = 400.0
+PLAYER_FONT_SIZE = 36.0
+PLAYER_OUTLINE_SIZE = 4.0
+
+# How long a heckle stays up when the annotation doesn't say; the player
+# starts fading it out after seven seconds and it is gone after ten.
+DEFAULT_DURATION = 10.0
+
+ASS_HEADER = u"""[Script Info]
+ScriptType: v4.00+
+PlayResX: {width}
+PlayResY: {height}
+WrapStyle: 0
+ScaledBorderAndShadow: yes
+
+[V4+ Styles]
+Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, Alignment, MarginL, MarginR, MarginV, Encoding
+Style: Snarky,{font},{fontsize},&H00FFFFFF,&H00FFFFFF,&H00000000,&H00000000,0,0,0,0,100,100,0,0,1,{outline},0,2,{margin},{margin},{margin},1
+
+[Events]
+Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
+"""
+
+def probe(video):
+    """Return the (width, height) and frame rate of the first video stream"""
+    output = subprocess.check_output([
+        'ffprobe', '-v', 'error', '-select_streams', 'v:0',
+        '-show_entries', 'stream=width,height,avg_frame_rate', '-of', 'json', video])
+    stream = json.loads(output)['streams'][0]
+    numerator, _, denominator = stream.get('avg_frame_rate', '0/0').partition('/')
+    try:
+        fps = float(numerator) / float(denominator or 1)
+    except ZeroDivisionError:
+        fps = 0
+    return (stream['width'], stream['height']), fps or 25.0
+
+def filter_escape(value):
+    """Escape a value for use as a filter option inside a filtergraph"""
+    for char in '\\\':':
+        value = value.replace(char, '\\' + char)
+    for char in '\\\'[],;':
+        value = value.replace(char, '\\' + char)
+    return value
+
+def ass_header(size, font):
+    width, height = size
+    scale = height / PLAYER_HEIGHT
+    return ASS_HEADER.format(
+        width=width, height=height, font=font,
+        fontsize=int(PLAYER_FONT_SIZE * scale),
+        outline=max(1, int(PLAYER_OUTLINE_SIZE * scale)),
+        margin=int(PLAYER_FONT_SIZE * scale / 2))
+
+def ass_time(seconds):
+    centiseconds = int(round(seconds * 100))
+    return u'{}:{:02d}:{:02d}.{:02d}'.format(
+        centiseconds // 360000, centiseconds // 6000 % 60, centiseconds // 100 % 60, centiseconds % 100)
+
+def ass_event(start, end, text):
+    return u'Dialogue: 0,{},{},Snarky,,0,0,0,,{}\n'.format(ass_time(start), ass_time(end), slack_to_ass(text))
+
+def cue_time(seconds, separator):
+    milliseconds = int(round(seconds * 1000))
+    return u'{:02d}:{:02d}:{:02d}{}{:03d}'.format(
+        milliseconds // 3600000, milliseconds // 60000 % 60, milliseconds // 1000 % 60,
+        separator, milliseconds % 1000)
+
+def timings(quotes):
+    """Yield (start, end, text) for each of a stream of (index, quote)"""
+    for index, quote in quotes:
+        start = float(quote['start'])
+        yield start, start + float(quote.get('duration', DEFAULT_DURATION)), quote['text']
+
+def write_ass(out, quotes, size, font):
+    out.write(ass_header(size, font))
+    for start, end, text in timings(quotes):
+        out.write(ass_event(start, end, text))
+
+def write_srt(out, quotes, size, font):
+    for number, (start, end, text) in enumerate(timings(quotes), 1):
+        out.write(u'{}\n{} --> {}\n{}\n\n'.format(
+            number, cue_time(start, u','), cue_time(end, u','), slack_to_plain(text)))
+
+def write_vtt(out, quotes, size, font):
+    out.write(u'WEBVTT\n\n')
+    for start, end, text in timings(quotes):
+        out.write(u'{} --> {} line:-1\n{}\n\n'.format(
+            cue_time(start, u'.'), cue_time(end, u'.'), slack_to_vtt(text)))
+
+WRITERS = {
+    '.ass': write_ass,
+    '.srt': write_srt,
+    '.vtt': write_vtt,
+}
+
+def write_subtitles(path, quotes, size, font):
+    writer = WRITERS[os.path.splitext(path)[1].lower()]
+    with codecs.open(path, 'w', 'utf-8') as out:
+        writer(out, quotes, size, font)
+
+def burn(video, quotes, output, size, font):
+    """Encode a copy of video with the heckles burnt in, in one pass"""
+    fd, subtitles = tempfile.mkstemp(suffix='.ass', prefix='snarky')
+    os.close(fd)
+    try:
+        write_subtitles(subtitles, quotes, size, font)
+        subprocess.check_call([
+            'ffmpeg', '-v', 'error', '-stats', '-y', '-i', video,
+            '-vf', 'ass=' + filter_escape(subtitles),
+            '-c:v', 'libx264', '-preset', 'medium', '-crf', '20', '-c:a', 'copy', output])
+    finally:
+        os.remove(subtitles)
+
+def main():
+    parser = argparse.ArgumentParser(description='Export heckles as a subtitle track.')
+    parser.add_argument('quotes')
+    parser.add_argument('output', help='.srt, .vtt or .ass file to write')
+    parser.add_argument('--video', help='the film, to size ASS captions to it')
+    parser.add_argument('--burn', metavar='MP4', help='also encode a copy of --video with the heckles burnt in')
+    parser.add_argument('--font', default='Sans', help='font name for ASS captions, e.g. "Lucida Fax"')
+    args = parser.parse_args()
+    if os.path.splitext(args.output)[1].lower() not in WRITERS:
+        parser.error('output must end in .srt, .vtt or .ass')
+    if args.burn and not args.video:
+        parser.error('--burn needs --video')
+
+    size = probe(args.video)[0] if args.video else (PLAYER_WIDTH, int(PLAYER_HEIGHT))
+
+    write_subtitles(args.output, in_time_order(iter_annotations(args.quotes)), size, args.font)
+    if args.burn:
+        burn(args.video, in_time_order(iter_annotations(args.quotes)), args.burn, size, args.font)
+
+if __name__ == '__main__':
+    main()